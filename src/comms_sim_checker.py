@@ -7,6 +7,10 @@ from marble_multi_agent.msg import CommsCheck
 from marble_multi_agent.msg import CommsCheckArray
 from std_msgs.msg import String
 
+# Heartbeat kinds, sent as a single character followed by the sender id
+PROBE = 'P'
+ECHO = 'E'
+
 
 class Neighbor(object):
     """ Data structure to hold pertinent information about other agents """
@@ -16,6 +20,8 @@ class Neighbor(object):
         self.lastCommCheckSend = rospy.get_rostime()
         self.lastCommCheckRecv = rospy.get_rostime()
         self.incomm = True
+        # Seconds between probes, which grows while the neighbor is out of range
+        self.probeInterval = 0
 
 
 class CommsChecker:
@@ -33,6 +39,14 @@ class CommsChecker:
         while self.start_time.secs == 0:
             self.start_time = rospy.get_rostime()
 
+        # Longest wait between probes to a neighbor that's out of range.  Any link changing state
+        # sets every down neighbor back to probing each cycle, so a recovery is usually seen quickly.
+        self.maxProbeInterval = rospy.get_param('~max_probe_interval', 4.0)
+        # Republish the link states at least this often, even if nothing changed
+        self.refreshInterval = rospy.Duration(rospy.get_param('~refresh_interval', 5.0))
+        self.lastPublish = rospy.Time(0)
+        self.lastStates = None
+
         # Get a list of the other agents from the comm control recv topics
         neighbors = []
         topics = rospy.get_published_topics('/' + agent + '_control')
@@ -56,16 +70,27 @@ class CommsChecker:
         self.comm_pub = rospy.Publisher(comm_topic, CommsCheckArray, queue_size=100)
 
     def CommReceiver(self, data):
-        readData = data.data.split('###')
-        sequence = readData[2]
-        nid = readData[3]
-        message = readData[4]
-
-        if sequence == 'CommCheck':
-            self.neighbors[nid].incomm = True
-            self.neighbors[nid].lastCommCheckRecv = rospy.get_rostime()
-            if message == 'ReturnToSender':
-                self.send_pub[nid].publish('###' + str(rospy.get_rostime()) + '###CommCheck###' + self.id + '###GoodComms')
+        if data.data.startswith('###'):
+            # Older checkers still send the delimited string
+            readData = data.data.split('###')
+            if readData[2] != 'CommCheck':
+                return
+            kind = PROBE if readData[4] == 'ReturnToSender' else ECHO
+            nid = readData[3]
+        else:
+            kind = data.data[:1]
+            nid = data.data[1:]
+
+        if nid not in self.neighbors:
+            return
+
+        neighbor = self.neighbors[nid]
+        neighbor.incomm = True
+        neighbor.lastCommCheckRecv = rospy.get_rostime()
+        # Anything heard means the link is up, so go back to probing every cycle
+        neighbor.probeInterval = 0
+        if kind == PROBE:
+            self.send_pub[nid].publish(ECHO + self.id)
 
     def start(self):
         rate = rospy.Rate(2)
@@ -75,10 +100,16 @@ class CommsChecker:
 
             comms = []
             for neighbor in self.neighbors.values():
-                self.send_pub[neighbor.id].publish('###' + str(curtime) + '###CommCheck###' + self.id + '###ReturnToSender')
-                neighbor.lastCommCheckSend = curtime
-                if (curtime > self.start_time + offset and
-                        neighbor.lastCommCheckSend > curtime - offset and
+                if curtime >= neighbor.lastCommCheckSend + rospy.Duration(neighbor.probeInterval):
+                    self.send_pub[neighbor.id].publish(PROBE + self.id)
+                    neighbor.lastCommCheckSend = curtime
+
+                    # Back off on neighbors that haven't answered, up to the max interval
+                    if not neighbor.incomm:
+                        neighbor.probeInterval = min(max(neighbor.probeInterval * 2, 0.5),
+                                                     self.maxProbeInterval)
+
+                if (neighbor.incomm and curtime > self.start_time + offset and
                         neighbor.lastCommCheckRecv < curtime - offset):
                     neighbor.incomm = False
                     # print("lost comm with", neighbor.id, "from", self.id)
@@ -89,8 +120,17 @@ class CommsChecker:
                 check.incomm = neighbor.incomm
                 comms.append(check)
 
-            # Publish our list
-            self.comm_pub.publish(comms)
+            # Only publish on a link transition, or when the refresh is due
+            states = [(check.id, check.incomm) for check in comms]
+            if self.lastStates is not None and states != self.lastStates:
+                # Agents moved, so links that were down may be back.  Probe them all next cycle.
+                for neighbor in self.neighbors.values():
+                    neighbor.probeInterval = 0
+            if states != self.lastStates or curtime - self.lastPublish > self.refreshInterval:
+                # Publish our list
+                self.comm_pub.publish(comms)
+                self.lastStates = states
+                self.lastPublish = curtime
             rate.sleep()
         return
 
@@ -1,49 +1,142 @@
 #!/usr/bin/env python
+from __future__ import print_function
 import sys
+import time
+import argparse
 import threading
 import rospy
 from subt_example.srv import CreatePeer
+from subt_example.srv import CreatePeerResponse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 class CommsHandler:
     """ Setup comms between two agents using the DARPA comms simulator """
 
-    def __init__(self, source, dest):
-        self.subData = None
-
+    def __init__(self, source, dest, retries=3):
         self.source = source
         self.dest = dest
+        self.retries = retries
+        self.attempts = 0
+        # Directions still to set up, so a retry doesn't create a peer twice
+        self.pending = [(source, dest), (dest, source)]
 
-        # Setup peer-connections topics from subt_example node
-        service1 = '/' + source + '_control/create_peer'
-        service2 = '/' + dest + '_control/create_peer'
-        print("Waiting for services {} {}".format(service1, service2))
+    def call(self, agent, peer):
+        service = '/' + agent + '_control/create_peer'
+        print("Calling service {}".format(service))
+        rospy.ServiceProxy(service, CreatePeer).call(peer)
 
-        rospy.wait_for_service(service1)
-        rospy.wait_for_service(service2)
-        print("Calling service {}".format(service1))
-        rospy.ServiceProxy(service1, CreatePeer).call(dest)
-        print("Calling service {}".format(service2))
-        rospy.ServiceProxy(service2, CreatePeer).call(source)
+    def run(self):
+        # Setup peer-connections topics from subt_example node, retrying on failure
+        while True:
+            self.attempts += 1
+            try:
+                while self.pending:
+                    self.call(*self.pending[0])
+                    self.pending.pop(0)
+                return True
+            except (rospy.ServiceException, rospy.ROSException) as e:
+                print("Peer {} {} attempt {} failed: {}".format(self.source, self.dest, self.attempts, e))
+                if self.attempts > self.retries:
+                    return False
+                time.sleep(0.5 * self.attempts)
 
 
 class CommsRun(threading.Thread):
-    def __init__(self, source, dest):
-        self.comm = CommsHandler(source, dest)
+    """ Worker that sets up agent pairs from a shared queue """
+
+    def __init__(self, pairs, results):
+        self.pairs = pairs
+        self.results = results
         threading.Thread.__init__(self)
+        self.daemon = True
 
+    def run(self):
+        while True:
+            try:
+                comm = self.pairs.get_nowait()
+            except queue.Empty:
+                return
 
-if __name__ == '__main__':
-    # Run as: python2 comms_sim_handler.py X1 X2 X3 X4
-    if len(sys.argv) < 3:
-        print("Node requires at least 2 agent names")
-        exit()
+            self.results.append((comm, comm.run()))
+
+
+class StubPeerService:
+    """ Stand-in for the create_peer services of the comms simulator, for timing setup without it """
+
+    def __init__(self, agents, delay):
+        self.delay = delay
+        self.services = []
+        for agent in agents:
+            service = '/' + agent + '_control/create_peer'
+            self.services.append(rospy.Service(service, CreatePeer, self.createPeer))
+
+    def createPeer(self, req):
+        time.sleep(self.delay)
+        return CreatePeerResponse()
+
+
+def setupPeers(agents, workers, retries):
+    # Wait for each agent's service once, rather than for every pair
+    for agent in agents:
+        service = '/' + agent + '_control/create_peer'
+        print("Waiting for service {}".format(service))
+        rospy.wait_for_service(service)
 
     # Start a connection between each agent in the list given
+    pairs = queue.Queue()
     i = 1
-    for agent1 in sys.argv[i:]:
-        for agent2 in sys.argv[i + 1:]:
-            CommsRun(agent1, agent2)
+    for agent1 in agents:
+        for agent2 in agents[i:]:
+            pairs.put(CommsHandler(agent1, agent2, retries))
         i += 1
+    total = pairs.qsize()
+
+    start = time.time()
+    results = []
+    threads = [CommsRun(pairs, results) for _ in range(min(workers, total))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Report how the setup went
+    failed = [comm for comm, success in results if not success]
+    retried = sum(1 for comm, success in results if comm.attempts > 1)
+    print("Created {}/{} peer pairs in {:.2f}s with {} workers, {} retried".format(
+        total - len(failed), total, time.time() - start, len(threads), retried))
+    for comm in failed:
+        print("Failed to create peers {} {}".format(comm.source, comm.dest))
+
+    return not failed
+
+
+if __name__ == '__main__':
+    # Run as: python2 comms_sim_handler.py X1 X2 X3 X4
+    parser = argparse.ArgumentParser()
+    parser.add_argument('agents', nargs='*')
+    parser.add_argument('--workers', type=int, default=8, help="Pairs to set up at once")
+    parser.add_argument('--retries', type=int, default=3, help="Retries for each failed pair")
+    parser.add_argument('--stub', type=float, default=None, metavar='DELAY',
+                        help="Serve stand-in create_peer services that take DELAY seconds, for benchmarking")
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    if len(args.agents) < 2:
+        print("Node requires at least 2 agent names")
+        exit()
 
     rospy.init_node('CommsHandler', anonymous=True)
+
+    if args.stub is not None:
+        stub = StubPeerService(args.agents, args.stub)
+
+    success = setupPeers(args.agents, max(args.workers, 1), args.retries)
+
+    if args.stub is not None:
+        rospy.signal_shutdown('Benchmark complete')
+
+    sys.exit(0 if success else 1)
@@ -25,10 +25,18 @@ class MABase(MultiAgent):
         self.useMonitor = True
         # Distance to fuse artifacts within.  May want smaller to account for missed score reports.
         self.fuseDist = rospy.get_param('multi_agent/fuseDist', 3.0)
+        # Seconds to wait for a score before reporting an artifact again, doubling each attempt
+        self.reportRetry = rospy.get_param('multi_agent/reportRetry', 5.0)
+        self.reportMaxRetry = rospy.get_param('multi_agent/reportMaxRetry', 60.0)
+        # Max number of reports waiting on a score at once
+        self.reportMaxInFlight = rospy.get_param('multi_agent/reportMaxInFlight', 3)
         # Storage for fused artifacts and reporting
         self.fusedArtifacts = {}
+        # Number of attempts and next attempt time for each fused artifact being reported
+        self.reportSchedule = {}
         self.fused_pub = rospy.Publisher('artifact_report', Artifact, queue_size=10)
         self.score_sub = rospy.Subscriber('artifact_score', ArtifactScore, self.GetArtifactScore)
+        self.journalHandlers['score'] = (ArtifactScore, self.replayScore)
 
         for nid in self.neighbors:
             self.addGUIMonitor(nid)
@@ -51,6 +59,11 @@ class MABase(MultiAgent):
 
         self.monitor['artifacts'] = rospy.Publisher('martifacts', MarkerArray, queue_size=10)
         self.martifact = MarkerArray()
+        # Stable marker id and last published state for each artifact
+        self.markerIds = {}
+        self.markerStates = {}
+        self.nextMarkerId = 0
+        self.lastMarkerRefresh = rospy.Time()
 
         self.commListen = True
 
@@ -66,56 +79,100 @@ class MABase(MultiAgent):
         self.monitor[nid]['guiReset'] = \
             rospy.Subscriber(topic + 'guiReset', AgentReset, self.GuiResetReceiver, nid)
 
-    def buildArtifactMarkers(self):
-        i = 0
+    def buildArtifactMarker(self, artifact):
+        martifact = Marker()
+        martifact.header.frame_id = 'world'
+        martifact.id = self.markerIds[artifact.id]
+        martifact.type = martifact.TEXT_VIEW_FACING
+        martifact.action = martifact.ADD
+
+        # Highlight new artifacts
+        if artifact.new:
+            martifact.scale.x = 10.0
+            martifact.scale.y = 10.0
+            martifact.scale.z = 10.0
+        else:
+            martifact.scale.x = 1.0
+            martifact.scale.y = 1.0
+            martifact.scale.z = 1.0
+
+        martifact.color.a = 1.0
+        martifact.color.r = 1.0
+        martifact.color.g = 1.0
+        martifact.color.b = 1.0
+        martifact.pose.position = artifact.artifact.position
+        martifact.text = artifact.artifact.obj_class
+
+        return martifact
+
+    def buildArtifactMarkers(self, refresh):
+        # Only add markers that are new or changed, unless refreshing everything
         self.martifact.markers = []
         for artifact in self.artifacts.values():
-
-            martifact = Marker()
-            martifact.header.frame_id = 'world'
-            martifact.id = i
-            martifact.type = martifact.TEXT_VIEW_FACING
-            martifact.action = martifact.ADD
-
-            # Highlight new artifacts, and check if it's now old
+            # Check if it's now old
             if artifact.new:
-                martifact.scale.x = 10.0
-                martifact.scale.y = 10.0
-                martifact.scale.z = 10.0
-
                 try:
                     if artifact.firstSeen < rospy.get_rostime() - rospy.Duration(30):
                         artifact.new = False
                 except TypeError:
                     continue
-            else:
-                martifact.scale.x = 1.0
-                martifact.scale.y = 1.0
-                martifact.scale.z = 1.0
 
-            martifact.color.a = 1.0
-            martifact.color.r = 1.0
-            martifact.color.g = 1.0
-            martifact.color.b = 1.0
-            martifact.pose.position = artifact.artifact.position
-            martifact.text = artifact.artifact.obj_class
+            # Each artifact keeps the same marker id so RViz updates it in place
+            if artifact.id not in self.markerIds:
+                self.markerIds[artifact.id] = self.nextMarkerId
+                self.nextMarkerId += 1
 
+            position = artifact.artifact.position
+            state = (artifact.new, position.x, position.y, position.z, artifact.artifact.obj_class)
+            if refresh or self.markerStates.get(artifact.id) != state:
+                self.markerStates[artifact.id] = state
+                self.martifact.markers.append(self.buildArtifactMarker(artifact))
+
+        # Delete markers for artifacts that have been removed
+        for aid in [aid for aid in self.markerStates if aid not in self.artifacts]:
+            martifact = Marker()
+            martifact.header.frame_id = 'world'
+            martifact.id = self.markerIds[aid]
+            martifact.action = martifact.DELETE
             self.martifact.markers.append(martifact)
-            i = i + 1
+            del self.markerStates[aid]
 
     def publishNeighbors(self):
-        self.mbeacon.points = []
-        for beacon in self.beacons.values():
-            if beacon.active:
-                self.mbeacon.points.append(beacon.pos)
-        self.monitor['beacons'].publish(self.mbeacon)
+        refresh = rospy.get_rostime() - self.lastMarkerRefresh > self.monitorRefresh
+        if refresh:
+            self.lastMarkerRefresh = rospy.get_rostime()
+
+        # Beacons only ever get added, so only rebuild when there's a new one
+        if refresh or len(self.mbeacon.points) != len(self.beaconsArray):
+            self.mbeacon.points = [beacon.pos for beacon in self.beaconsArray]
+            self.monitor['beacons'].publish(self.mbeacon)
+            self.countSent('monitor/beacons', self.mbeacon)
 
-        self.buildArtifactMarkers()
-        self.monitor['artifacts'].publish(self.martifact)
+        self.buildArtifactMarkers(refresh)
+        if self.martifact.markers:
+            self.monitor['artifacts'].publish(self.martifact)
+            self.countSent('monitor/artifacts', self.martifact)
 
     def GetArtifactScore(self, data):
         self.fusedArtifacts[data.id].score = data.score
         self.fusedArtifacts[data.id].reported = True
+        self.journalAppend('score', data.id, data)
+
+    def journalState(self):
+        records = MultiAgent.journalState(self)
+        for artifact in self.fusedArtifacts.values():
+            if artifact.reported:
+                score = ArtifactScore()
+                score.id = artifact.id
+                score.score = artifact.score
+                records.append(('score', artifact.id, score))
+
+        return records
+
+    def replayScore(self, key, data):
+        if key in self.fusedArtifacts:
+            self.fusedArtifacts[key].score = data.score
+            self.fusedArtifacts[key].reported = True
 
     def AddRobotReceiver(self, data):
         # Add a new robot to the system, which will propogate to any other agents in comms
@@ -214,9 +271,30 @@ class MABase(MultiAgent):
             self.fusedArtifacts[artifact.id].originals[artifact.id] = artifact
 
     def reportArtifacts(self):
-        for artifact in self.fusedArtifacts.values():
-            if not artifact.reported:
-                self.fused_pub.publish(artifact.artifact)
+        now = rospy.get_rostime()
+        # Forget artifacts that have been scored or replaced by a new fusion
+        for fid in [fid for fid in self.reportSchedule
+                    if fid not in self.fusedArtifacts or self.fusedArtifacts[fid].reported]:
+            del self.reportSchedule[fid]
+
+        # Reports still waiting for a score
+        inFlight = len([fid for fid in self.reportSchedule if self.reportSchedule[fid][1] > now])
+
+        # Newly fused artifacts first, then the most likely to score
+        pending = [artifact for artifact in self.fusedArtifacts.values() if not artifact.reported and
+                   (artifact.id not in self.reportSchedule or self.reportSchedule[artifact.id][1] <= now)]
+        pending.sort(key=lambda artifact: (self.reportSchedule.get(artifact.id, (0,))[0],
+                                           -artifact.artifact.obj_prob))
+
+        for artifact in pending:
+            if inFlight >= self.reportMaxInFlight:
+                break
+
+            attempts = self.reportSchedule.get(artifact.id, (0,))[0]
+            delay = min(self.reportRetry * 2 ** attempts, self.reportMaxRetry)
+            self.fused_pub.publish(artifact.artifact)
+            self.reportSchedule[artifact.id] = (attempts + 1, now + rospy.Duration(delay))
+            inFlight += 1
 
     def run(self):
         self.updateArtifacts()
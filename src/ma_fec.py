@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import math
+import time
+import random
+
+# Arithmetic in GF(256) with the 0x11d polynomial, as used by Reed-Solomon codes
+EXP = bytearray(512)
+LOG = [0] * 256
+value = 1
+for power in range(255):
+    EXP[power] = value
+    LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11d
+for power in range(255, 512):
+    EXP[power] = EXP[power - 255]
+
+# Translation table for multiplying every byte of a chunk by a constant, built as needed
+MUL = {}
+
+# Most chunks, data and parity together, that one code block can have in GF(256)
+MAX_CHUNKS = 255
+
+
+def gfMul(a, b):
+    if not a or not b:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gfInv(a):
+    return EXP[255 - LOG[a]]
+
+
+def mulTable(c):
+    if c not in MUL:
+        MUL[c] = bytes(bytearray(gfMul(c, x) for x in range(256)))
+    return MUL[c]
+
+
+if hasattr(int, 'from_bytes'):
+    def xorBytes(a, b):
+        return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+else:
+    def xorBytes(a, b):
+        return bytes(bytearray(x ^ y for x, y in zip(bytearray(a), bytearray(b))))
+
+
+def combine(coefs, chunks):
+    # Sum of each chunk times its coefficient, byte by byte
+    result = bytes(bytearray(len(chunks[0])))
+    for coef, chunk in zip(coefs, chunks):
+        if coef:
+            result = xorBytes(result, bytes(bytearray(chunk).translate(mulTable(coef))))
+    return result
+
+
+def cauchy(row, col, k):
+    # Every square submatrix of a Cauchy matrix is invertible, so any k chunks are enough
+    return gfInv((k + row) ^ col)
+
+
+def encode(data, chunkSize, parity):
+    """
+    Split data into k chunks of chunkSize, followed by parity chunks.
+    Any k of the k + parity chunks rebuild the data.
+    """
+    k = max((len(data) + chunkSize - 1) // chunkSize, 1)
+    if k + parity > MAX_CHUNKS:
+        raise ValueError('%d data and %d parity chunks is more than one block can hold' % (k, parity))
+    data = bytes(data) + bytes(bytearray(k * chunkSize - len(data)))
+    chunks = [data[i * chunkSize:(i + 1) * chunkSize] for i in range(k)]
+    for row in range(parity):
+        chunks.append(combine([cauchy(row, col, k) for col in range(k)], chunks[:k]))
+    return chunks
+
+
+def parityCount(k, ratio):
+    return max(int(math.ceil(k * ratio)), 1)
+
+
+def encodeBlocks(data, chunkSize, ratio):
+    """
+    Encode data of any size as blocks of at most MAX_CHUNKS chunks, each with ratio of its data chunks as parity.
+    Returns (offset, length, k, chunks) for each block, so every block can be rebuilt on its own.
+    """
+    blockK = MAX_CHUNKS - 1
+    while blockK + parityCount(blockK, ratio) > MAX_CHUNKS:
+        blockK -= 1
+
+    blocks = []
+    blockBytes = blockK * chunkSize
+    for offset in range(0, max(len(data), 1), blockBytes):
+        block = data[offset:offset + blockBytes]
+        k = max((len(block) + chunkSize - 1) // chunkSize, 1)
+        blocks.append((offset, len(block), k, encode(block, chunkSize, parityCount(k, ratio))))
+    return blocks
+
+
+def invert(matrix):
+    # Gauss-Jordan elimination in GF(256)
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gfInv(rows[col][col])
+        rows[col] = [gfMul(scale, x) for x in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gfMul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+def decode(chunks, k, size):
+    """ Rebuild the data from a dict of chunk index to chunk, or None if there aren't enough yet """
+    if len(chunks) < k:
+        return None
+
+    data = [chunks.get(i) for i in range(k)]
+    missing = [i for i in range(k) if data[i] is None]
+    if missing:
+        # Take out the known data chunks from enough parity chunks, then solve for the rest
+        rows = sorted(i - k for i in chunks if i >= k)[:len(missing)]
+        known = [i for i in range(k) if data[i] is not None]
+        remainders = []
+        for row in rows:
+            coefs = [cauchy(row, col, k) for col in known]
+            remainders.append(xorBytes(chunks[k + row], combine(coefs, [data[i] for i in known])) if known
+                              else chunks[k + row])
+
+        inverse = invert([[cauchy(row, col, k) for col in missing] for row in rows])
+        for i, col in enumerate(missing):
+            data[col] = combine(inverse[i], remainders)
+
+    return b''.join(data)[:size]
+
+
+class FecPayload(object):
+    """ Blocks of one payload still being rebuilt """
+
+    def __init__(self, size, now):
+        self.firstSeen = now
+        self.size = size
+        # Sends that have contributed chunks, which are all finished once the payload is rebuilt
+        self.serials = set()
+        # Block offset to (k, length, index to chunk) while coming in, and to the data once rebuilt
+        self.blocks = {}
+        self.decoded = {}
+
+
+class FecAssembler(object):
+    """
+    Collects coded chunks for each key until enough have arrived to rebuild the payload.
+    Encoding is deterministic, so chunks from different sends of the same payload combine.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        # Key to the FecPayload being rebuilt
+        self.partial = {}
+        # (key, serial) of sends rebuilt recently, so their late chunks are ignored
+        self.done = {}
+
+    def add(self, key, k, size, index, data, now, serial=0, offset=0, length=None):
+        for old in [old for old, entry in self.partial.items() if now - entry.firstSeen > self.timeout]:
+            del self.partial[old]
+        for old in [old for old, stamp in self.done.items() if now - stamp > self.timeout]:
+            del self.done[old]
+
+        # A new send of a payload we already rebuilt starts over, and is handled again
+        if (key, serial) in self.done:
+            return None
+
+        if length is None:
+            length = size
+        entry = self.partial.get(key)
+        if not entry or entry.size != size:
+            # The payload changed since the last send, so start over
+            entry = FecPayload(size, now)
+            self.partial[key] = entry
+        entry.serials.add(serial)
+        if offset in entry.decoded:
+            return None
+
+        block = entry.blocks.get(offset)
+        if not block or block[0] != k or block[1] != length:
+            block = (k, length, {})
+            entry.blocks[offset] = block
+
+        block[2][index] = bytes(data)
+        blockData = decode(block[2], k, length)
+        if blockData is None:
+            return None
+
+        del entry.blocks[offset]
+        entry.decoded[offset] = blockData
+        if sum(len(blockData) for blockData in entry.decoded.values()) < size:
+            return None
+
+        del self.partial[key]
+        for serial in entry.serials:
+            self.done[(key, serial)] = now
+        return b''.join(entry.decoded[offset] for offset in sorted(entry.decoded))
+
+
+class LossyLink(object):
+    """
+    Simulated link that loses messages in bursts (Gilbert-Elliott model), for testing FEC locally.
+    Each message is lost with lossGood or lossBad depending on the state, which switches with pBad and pGood.
+    """
+
+    def __init__(self, lossGood=0.05, lossBad=0.5, pBad=0.05, pGood=0.3, seed=None):
+        self.lossGood = lossGood
+        self.lossBad = lossBad
+        self.pBad = pBad
+        self.pGood = pGood
+        self.bad = False
+        self.random = random.Random(seed)
+
+    def deliver(self, messages):
+        delivered = []
+        for message in messages:
+            if self.random.random() < (self.pGood if self.bad else self.pBad):
+                self.bad = not self.bad
+            if self.random.random() >= (self.lossBad if self.bad else self.lossGood):
+                delivered.append(message)
+        return delivered
+
+
+if __name__ == '__main__':
+    # Run as: python ma_fec.py [payload bytes] [chunk bytes] [parity percent] [trials]
+    args = [int(arg) for arg in sys.argv[1:]]
+    payloadSize, chunkSize, parityPercent, trials = args + [200000, 8000, 25, 200][len(args):]
+
+    link = LossyLink(seed=1)
+    plain = coded = 0
+    start = time.time()
+    for trial in range(trials):
+        payload = os.urandom(payloadSize)
+        blocks = encodeBlocks(payload, chunkSize, parityPercent / 100.0)
+        k = sum(block[2] for block in blocks)
+        total = sum(len(block[3]) for block in blocks)
+
+        # Without coding every data chunk has to arrive
+        if len(link.deliver(range(k))) == k:
+            plain += 1
+
+        assembler = FecAssembler(60)
+        result = None
+        for offset, length, blockK, chunks in blocks:
+            for index in link.deliver(range(len(chunks))):
+                result = assembler.add('trial', blockK, payloadSize, index, chunks[index], 0,
+                                       trial, offset, length) or result
+        if result is not None:
+            assert result == payload
+            coded += 1
+
+    print("{} trials of {} bytes in {} chunks and {} blocks: {} delivered without coding, {} with {} parity chunks "
+          "({:.2f}s)".format(trials, payloadSize, k, len(blocks), plain, coded, total - k, time.time() - start))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import bisect
+import hashlib
+import struct
+
+# Size of the bloom filter of held images, and the number of bits set for each key
+BLOOM_BYTES = 128
+BLOOM_HASHES = 3
+
+
+def seqRanges(seqs):
+    # Flatten a set of sequence numbers into [first, last, first, last, ...] runs
+    ranges = []
+    for seq in sorted(set(seqs)):
+        if ranges and seq == ranges[-1] + 1:
+            ranges[-1] = seq
+        else:
+            ranges += [seq, seq]
+    return ranges
+
+
+def bloomBits(key):
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return [index % (BLOOM_BYTES * 8) for index in struct.unpack('<%dI' % BLOOM_HASHES, digest[:4 * BLOOM_HASHES])]
+
+
+def bloomFilter(keys):
+    bloom = bytearray(BLOOM_BYTES)
+    for key in keys:
+        for bit in bloomBits(key):
+            bloom[bit // 8] |= 1 << (bit % 8)
+    return bytes(bloom)
+
+
+class Holdings(object):
+    """ What a peer has advertised it can serve: diff sequence ranges for each owner, and a bloom of images """
+
+    def __init__(self, heldDiffs, heldImages):
+        # Owner to (first seqs, last seqs) of each run, for bisecting
+        self.diffs = {}
+        for summary in heldDiffs:
+            ranges = list(summary.ranges)
+            self.diffs[summary.owner] = (ranges[0::2], ranges[1::2])
+        self.bloom = bytearray(heldImages)
+
+    def hasDiff(self, owner, seq):
+        if owner not in self.diffs:
+            return False
+
+        firsts, lasts = self.diffs[owner]
+        i = bisect.bisect_right(firsts, seq) - 1
+        return i >= 0 and seq <= lasts[i]
+
+    def lastSeq(self, owner):
+        # Newest diff held for this owner, or -1 for none
+        if owner not in self.diffs or not self.diffs[owner][1]:
+            return -1
+        return self.diffs[owner][1][-1]
+
+    def hasImage(self, key):
+        # May be wrong the other way round, but never misses an image that's there
+        if len(self.bloom) != BLOOM_BYTES or not key:
+            return False
+        return all(self.bloom[bit // 8] & (1 << (bit % 8)) for bit in bloomBits(key))
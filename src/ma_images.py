@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+
+
+def imageDigest(img):
+    # Content address of an image, so identical bytes get the same key wherever they came from
+    data = bytearray(img.data)
+    return hashlib.sha1(img.format.encode('utf-8') + bytes(data)).hexdigest()
+
+
+def chunkCrc(data):
+    return zlib.crc32(bytes(data)) & 0xffffffff
+
+
+class ImageTransfer(object):
+    """
+    Chunks received so far of one image, identified by its digest.
+    Chunks of the same bytes can come from any peer, so a transfer resumes wherever it stopped.
+    """
+
+    def __init__(self, digest, size, count):
+        self.digest = digest
+        self.size = size
+        self.count = count
+        self.chunks = {}
+
+    def add(self, index, crc, data):
+        # Returns the whole serialized image once the last chunk is in
+        data = bytes(data)
+        if index >= self.count or index in self.chunks or chunkCrc(data) != crc:
+            return None
+
+        self.chunks[index] = data
+        if len(self.chunks) < self.count:
+            return None
+
+        return b''.join(self.chunks[i] for i in range(self.count))[:self.size]
+
+    def missing(self):
+        return [i for i in range(self.count) if i not in self.chunks]
+
+
+class ImageStore(object):
+    """
+    Content-addressed store for artifact images.
+    Every image is written to a local file, and the most recently used are kept in memory.
+    """
+
+    def __init__(self, path, cacheSize, imgClass):
+        self.path = path
+        self.cacheSize = cacheSize
+        self.imgClass = imgClass
+        self.lock = threading.Lock()
+
+        # Digest to image, least recently used first
+        self.cache = OrderedDict()
+        self.cacheBytes = 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def cacheImage(self, digest, img):
+        # Must hold the lock
+        if digest in self.cache:
+            self.cache[digest] = self.cache.pop(digest)
+            return
+
+        self.cache[digest] = img
+        self.cacheBytes += len(img.data)
+        while self.cacheBytes > self.cacheSize and len(self.cache) > 1:
+            oldImg = self.cache.popitem(last=False)[1]
+            self.cacheBytes -= len(oldImg.data)
+
+    def put(self, img):
+        digest = imageDigest(img)
+        with self.lock:
+            filename = os.path.join(self.path, digest)
+            if not os.path.exists(filename):
+                buff = BytesIO()
+                img.serialize(buff)
+                # Write then rename so a crash never leaves a partial image under its digest
+                with open(filename + '.tmp', 'wb') as imgFile:
+                    imgFile.write(buff.getvalue())
+                os.rename(filename + '.tmp', filename)
+
+            self.cacheImage(digest, img)
+
+        return digest
+
+    def has(self, digest):
+        return digest in self.cache or os.path.exists(os.path.join(self.path, digest))
+
+    def get(self, digest):
+        with self.lock:
+            if digest not in self.cache:
+                with open(os.path.join(self.path, digest), 'rb') as imgFile:
+                    img = self.imgClass().deserialize(imgFile.read())
+                self.cacheImage(digest, img)
+
+            img = self.cache.pop(digest)
+            self.cache[digest] = img
+            return img
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import struct
+import threading
+import zlib
+from io import BytesIO
+
+# Record header: crc32, kind length, key length, payload length
+HEADER = struct.Struct('<IHHI')
+
+
+class StateJournal(object):
+    """
+    Append-only file of state records so a restarted node can recover without the mesh.
+    Each record is a kind, a key and an optional serialized ROS message.
+    Records can be appended from any thread, and compaction writes the new file in the background.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Number of records that have been superseded since the last compaction
+        self.dead = 0
+        # Guards the file, which compaction swaps out from under appends
+        self.lock = threading.Lock()
+        # Records appended while a compaction is writing, to carry over to the new file
+        self.compacting = None
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Drop any torn write left by a crash so new records aren't appended after it
+        if os.path.exists(self.path):
+            end = 0
+            for kind, key, payload in self.records():
+                end += HEADER.size + len(kind.encode('utf-8')) + len(key.encode('utf-8')) + len(payload)
+            if end < os.path.getsize(self.path):
+                with open(self.path, 'r+b') as journal:
+                    journal.truncate(end)
+
+        self.file = open(self.path, 'ab')
+
+    def encode(self, kind, key, msg):
+        kind = kind.encode('utf-8')
+        key = key.encode('utf-8')
+        payload = b''
+        if msg is not None:
+            buff = BytesIO()
+            msg.serialize(buff)
+            payload = buff.getvalue()
+
+        body = kind + key + payload
+        crc = zlib.crc32(body) & 0xffffffff
+        return HEADER.pack(crc, len(kind), len(key), len(payload)) + body
+
+    def append(self, kind, key, msg=None):
+        record = self.encode(kind, key, msg)
+        with self.lock:
+            self.file.write(record)
+            if self.compacting is not None:
+                self.compacting.append(record)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def records(self):
+        # Read back every complete record.  A torn write at the end (from a crash) ends the replay.
+        with open(self.path, 'rb') as journal:
+            while True:
+                header = journal.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+
+                crc, kindLen, keyLen, payloadLen = HEADER.unpack(header)
+                body = journal.read(kindLen + keyLen + payloadLen)
+                if len(body) < kindLen + keyLen + payloadLen or zlib.crc32(body) & 0xffffffff != crc:
+                    break
+
+                kind = body[:kindLen].decode('utf-8')
+                key = body[kindLen:kindLen + keyLen].decode('utf-8')
+                yield kind, key, body[kindLen + keyLen:]
+
+    def compact(self, getRecords):
+        """
+        Start replacing the journal with the current state from getRecords, unless a compaction is still running.
+        The state is taken under the lock, so every append lands either in it or in the records carried over.
+        Records are encoded now, so later changes to the messages don't leak in, and written by a worker.
+        """
+        with self.lock:
+            if self.compacting is not None:
+                return False
+            encoded = [self.encode(kind, key, msg) for kind, key, msg in getRecords()]
+            self.compacting = []
+            self.dead = 0
+
+        worker = threading.Thread(target=self.writeCompact, args=(encoded,))
+        worker.daemon = True
+        worker.start()
+        return True
+
+    def writeCompact(self, encoded):
+        try:
+            self.swapIn(encoded)
+        except (IOError, OSError):
+            # Keep appending to the old file, and try again at the next compaction
+            with self.lock:
+                self.compacting = None
+                self.dead += 1
+            raise
+
+    def swapIn(self, encoded):
+        # Write the current state to a new file and swap it in, so a crash leaves one or the other
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as journal:
+            for record in encoded:
+                journal.write(record)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            # Anything appended meanwhile is only in the old file, so copy it over before swapping
+            with self.lock:
+                for record in self.compacting:
+                    journal.write(record)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+                self.file.close()
+                os.rename(tmpPath, self.path)
+                self.file = open(self.path, 'ab')
+                self.compacting = None
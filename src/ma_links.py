@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+
+class LinkQuality(object):
+    """ Running estimates of how well messages get through to one peer """
+
+    __slots__ = ('interval', 'loss', 'success', 'latency', 'lastArrival', 'lastStamp', 'pending')
+
+    def __init__(self):
+        # Seconds between direct messages, and the fraction of their messages we miss
+        self.interval = None
+        self.loss = 0.0
+        # Fraction of DM requests answered, and seconds to the first answer
+        self.success = 1.0
+        self.latency = None
+        self.lastArrival = None
+        self.lastStamp = None
+        # Time of the DM request still waiting for an answer
+        self.pending = None
+
+
+class LinkTable(object):
+    """
+    Link quality to each peer, from direct message arrivals and DM request outcomes.
+    Estimates are exponentially weighted averages so they follow the link as it changes.
+    """
+
+    def __init__(self, alpha, rate):
+        self.alpha = alpha
+        # Rate peers publish at, to tell how many messages we missed between two we received
+        self.rate = rate
+        self.links = {}
+
+    def get(self, pid):
+        if pid not in self.links:
+            self.links[pid] = LinkQuality()
+        return self.links[pid]
+
+    def average(self, current, sample):
+        if current is None:
+            return sample
+        return current + self.alpha * (sample - current)
+
+    def messageReceived(self, pid, now, stamp):
+        link = self.get(pid)
+        if link.lastArrival is not None:
+            link.interval = self.average(link.interval, now - link.lastArrival)
+
+        # The sender stamps each message, so a gap larger than its period means we missed some
+        if link.lastStamp is not None and stamp > link.lastStamp:
+            expected = max(round((stamp - link.lastStamp) * self.rate), 1)
+            link.loss = self.average(link.loss, 1.0 - 1.0 / expected)
+
+        link.lastArrival = now
+        if link.lastStamp is None or stamp > link.lastStamp:
+            link.lastStamp = stamp
+
+    def requestSent(self, pid, now):
+        link = self.get(pid)
+        # A request that's still unanswered when we send another counts as a failure
+        if link.pending is not None:
+            link.success = self.average(link.success, 0.0)
+        link.pending = now
+
+    def responseReceived(self, pid, now):
+        link = self.get(pid)
+        if link.pending is not None:
+            link.success = self.average(link.success, 1.0)
+            link.latency = self.average(link.latency, now - link.pending)
+            link.pending = None
+
+    def requestExpired(self, pid):
+        link = self.get(pid)
+        if link.pending is not None:
+            link.success = self.average(link.success, 0.0)
+            link.pending = None
+
+    def expectedDelivery(self, pid, default):
+        # Seconds until a request is answered, counting the retries that failures and loss will need
+        link = self.links.get(pid)
+        if not link:
+            return default
+
+        latency = link.latency if link.latency is not None else default
+        # Peers we rarely hear from are likely at the edge of range, so wait on average half a gap
+        if link.interval is not None:
+            latency += link.interval / 2.0
+        delivery = max(link.success, 0.05) * max(1.0 - link.loss, 0.05)
+        return latency / delivery
+
+    def lossRate(self, pid):
+        link = self.links.get(pid)
+        return link.loss if link else 0.0
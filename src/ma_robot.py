@@ -168,6 +168,9 @@ class MARobot(MultiAgent):
         self.blacklist.color.g = 0.0
         self.blacklist.color.b = 1.0
 
+        self.journalHandlers['blacklist'] = (Point, self.replayBlacklist)
+        self.journalHandlers['blacklistClear'] = (None, self.replayBlacklistClear)
+
         self.commListen = True
 
     def WaitMonitor(self, data):
@@ -295,9 +298,8 @@ class MARobot(MultiAgent):
                 self.deploy_pub.publish(False)
 
                 self.numBeacons = self.numBeacons - 1
-                self.beacons[deploy].active = True
                 self.beacons[deploy].simcomm = True
-                self.beacons[deploy].pos = pose.position
+                self.activateBeacon(deploy, pose.position)
             except Exception as e:
                 rospy.logerr('Error deploying beacon %s', str(e))
         else:
@@ -437,6 +439,34 @@ class MARobot(MultiAgent):
             rospy.loginfo(self.id + ' added ' + goalstr + ' to blacklist')
             self.blacklist.points.append(goal)
             self.pub_blacklist.publish(self.blacklist)
+            self.journalAppend('blacklist', self.id, goal)
+
+    def clearBlacklist(self):
+        self.blacklist.points = []
+        self.journalAppend('blacklistClear', self.id)
+        if self.journal:
+            self.journal.dead += 1
+
+    def journalState(self):
+        records = MultiAgent.journalState(self)
+        for goal in self.blacklist.points:
+            records.append(('blacklist', self.id, goal))
+
+        return records
+
+    def replayBlacklist(self, key, goal):
+        self.blacklist.points.append(goal)
+        self.pub_blacklist.publish(self.blacklist)
+
+    def replayBlacklistClear(self, key, msg):
+        self.blacklist.points = []
+        self.pub_blacklist.publish(self.blacklist)
+
+    def replayFinish(self):
+        MultiAgent.replayFinish(self)
+        # Only go back to report if something we found still hasn't been reported
+        self.report = False
+        self.artifactCheckReport()
 
     def deconflictGoals(self):
         # Get all of the goals into a list
@@ -534,7 +564,7 @@ class MARobot(MultiAgent):
                     # All goals blacklisted, start going home, but clear the blacklist
                     self.agent.goal.pose = self.agent.exploreGoal
                     self.agent.goal.path = self.agent.explorePath
-                    self.blacklist.points = []
+                    self.clearBlacklist()
                     rospy.loginfo(self.id + ' all goals blacklisted ' + str(len(goals)))
                     self.useTraj = True
             else:
@@ -748,7 +778,9 @@ class MARobot(MultiAgent):
                 # Turn off reporting
                 self.report = False
                 for artifact in self.artifacts.values():
-                    artifact.reported = True
+                    if not artifact.reported:
+                        artifact.reported = True
+                        self.journalAppend('reported', artifact.id)
 
                 # Resume normal operation (check mode or explore)
                 rospy.loginfo(self.id + ' resuming operation...')
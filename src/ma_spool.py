@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+
+class SpoolView(object):
+    """ Lookup of one owner's diffs by sequence, for serving DMs straight from the spool """
+
+    def __init__(self, spool, owner):
+        self.spool = spool
+        self.owner = owner
+
+    def __contains__(self, seq):
+        return self.spool.contains(self.owner, seq)
+
+    def __getitem__(self, seq):
+        return self.spool.get(self.owner, seq)
+
+    def keys(self):
+        return self.spool.getSeqs(self.owner)
+
+
+class DiffSpool(object):
+    """
+    Map diffs for every neighbor, keeping the newest in memory up to a byte cap.
+    Older diffs are written to a segment file and read back through a memory map when needed.
+    """
+
+    def __init__(self, path, memCap):
+        self.path = path
+        self.memCap = memCap
+        self.diffClass = None
+        self.lock = threading.Lock()
+
+        # (owner, seq) to (diff, serialized diff) for diffs in memory, oldest first.
+        # The bytes are kept from measuring the diff so spilling it doesn't serialize it again.
+        self.memory = OrderedDict()
+        self.memBytes = 0
+        # (owner, seq) to (offset, length) for diffs in the segment file
+        self.index = {}
+        # Sequence numbers for each owner, in the order received
+        self.seqs = {}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The segment is only a cache, so start fresh each run
+        self.file = open(self.path, 'w+b')
+        self.size = 0
+        self.deadBytes = 0
+        self.map = None
+
+    def serialize(self, diff):
+        buff = BytesIO()
+        diff.serialize(buff)
+        return buff.getvalue()
+
+    def add(self, owner, diff):
+        if not self.diffClass:
+            self.diffClass = diff.__class__
+
+        key = (owner, diff.header.seq)
+        data = self.serialize(diff)
+        with self.lock:
+            if key in self.memory or key in self.index:
+                self.discard(key)
+            else:
+                self.seqs.setdefault(owner, []).append(diff.header.seq)
+            self.memory[key] = (diff, data)
+            self.memBytes += len(data)
+
+            # Spill the oldest diffs until we're back under the cap
+            while self.memBytes > self.memCap and len(self.memory) > 1:
+                oldKey, (oldDiff, oldData) = self.memory.popitem(last=False)
+                self.memBytes -= len(oldData)
+                self.file.seek(0, os.SEEK_END)
+                self.file.write(oldData)
+                self.index[oldKey] = (self.size, len(oldData))
+                self.size += len(oldData)
+
+    def read(self, offset, length):
+        # Remap if the segment has grown past what's mapped
+        if not self.map or offset + length > len(self.map):
+            self.file.flush()
+            if self.map:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.map[offset:offset + length]
+
+    def contains(self, owner, seq):
+        key = (owner, seq)
+        return key in self.memory or key in self.index
+
+    def get(self, owner, seq):
+        key = (owner, seq)
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key][0]
+            if key in self.index:
+                offset, length = self.index[key]
+                return self.diffClass().deserialize(self.read(offset, length))
+
+        return None
+
+    def load(self, owner):
+        # All of this owner's diffs, in the order received
+        return [self.get(owner, seq) for seq in list(self.seqs.get(owner, []))]
+
+    def getSeqs(self, owner):
+        return list(self.seqs.get(owner, []))
+
+    def view(self, owner):
+        return SpoolView(self, owner)
+
+    def discard(self, key):
+        # Must hold the lock
+        if key in self.memory:
+            self.memBytes -= len(self.memory.pop(key)[1])
+        elif key in self.index:
+            self.deadBytes += self.index.pop(key)[1]
+
+    def remove(self, owner, seq):
+        with self.lock:
+            self.discard((owner, seq))
+            if seq in self.seqs.get(owner, []):
+                self.seqs[owner].remove(seq)
+            self.compact()
+
+    def clear(self, owner):
+        with self.lock:
+            for seq in self.seqs.pop(owner, []):
+                self.discard((owner, seq))
+            self.compact()
+
+    def compact(self):
+        # Must hold the lock.  Rewrite the segment once most of it is removed diffs.
+        if self.deadBytes < 1000000 or self.deadBytes < self.size / 2:
+            return
+
+        tmpPath = self.path + '.tmp'
+        index = {}
+        size = 0
+        with open(tmpPath, 'wb') as segment:
+            for key, (offset, length) in self.index.items():
+                segment.write(self.read(offset, length))
+                index[key] = (size, length)
+                size += length
+
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        os.rename(tmpPath, self.path)
+        self.file = open(self.path, 'r+b')
+        self.index = index
+        self.size = size
+        self.deadBytes = 0
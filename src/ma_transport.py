@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import time
+import socket
+import struct
+import itertools
+import threading
+from io import BytesIO
+import rospy
+
+from marble_artifact_detection_msgs.msg import ArtifactImg
+from marble_multi_agent.msg import AgentMsg
+from marble_multi_agent.msg import DMReq
+from marble_multi_agent.msg import DMReqArray
+from marble_multi_agent.msg import DMResp
+from marble_multi_agent.msg import DMRespArray
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+# Datagram header: kind, sender id length, message number, fragment index, fragment count
+FRAME = struct.Struct('<cBIHH')
+# Largest datagram payload to send, leaving room for the header under the UDP limit
+MAX_FRAGMENT = 60000
+KINDS = {b'A': AgentMsg, b'Q': DMReqArray, b'R': DMRespArray}
+
+# Shared memory ring header: total bytes ever written, total bytes ever read, reader closed flag
+RING_HEADER = struct.Struct('<QQQ')
+# Ring record header: payload length, kind, fragment flags
+RECORD = struct.Struct('<IcB')
+FIRST_FRAGMENT = 1
+LAST_FRAGMENT = 2
+# Seconds a reader can make no progress while we feed it a message larger than the ring,
+# before we drop the rest and stop waiting on it until it reads again
+RING_STALL = 0.5
+
+
+class Transport(object):
+    """
+    How our agent data, DM requests and DM responses get to and from peers.
+    Received messages are passed to the handlers from the transport's own threads.
+    """
+
+    def __init__(self, agentId, dataHandler, requestHandler, responseHandler):
+        self.id = agentId
+        self.dataHandler = dataHandler
+        self.requestHandler = requestHandler
+        self.responseHandler = responseHandler
+        self.peers = set()
+
+    def addPeer(self, nid):
+        self.peers.add(nid)
+
+    def hasPeer(self, nid):
+        return nid in self.peers
+
+    def broadcast(self, msg):
+        raise NotImplementedError
+
+    def sendRequest(self, nid, msg):
+        raise NotImplementedError
+
+    def sendResponse(self, nid, msg):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def serialize(self, msg):
+        buff = BytesIO()
+        msg.serialize(buff)
+        return buff.getvalue()
+
+    def dispatch(self, kind, payload, sender):
+        # Hand a received serialized message to the handler for its kind
+        if kind not in KINDS:
+            return
+
+        msg = KINDS[kind]().deserialize(payload)
+        if kind == b'A':
+            self.dataHandler(msg)
+        elif kind == b'Q':
+            self.requestHandler(msg, sender)
+        else:
+            self.responseHandler(msg, sender)
+
+
+class RosTransport(Transport):
+    """ ROS topics, named for the UDP mesh, the virtual comms relay, or multimaster and the simulator """
+
+    def __init__(self, agentId, dataHandler, requestHandler, responseHandler, commTopic, pubTopic, mode):
+        Transport.__init__(self, agentId, dataHandler, requestHandler, responseHandler)
+        self.commTopic = commTopic
+        self.pubTopic = pubTopic
+        self.mode = mode
+        self.data_sub = {}
+        self.dmReq_pub = {}
+        self.dmReq_sub = {}
+        self.dmResp_pub = {}
+        self.dmResp_sub = {}
+
+        if mode == 'mesh':
+            # UDP Mesh broadcast publishes to one topic but subscribes to different
+            broadcastPubTopic = commTopic + '/' + pubTopic
+            self.broadcastSubTopic = commTopic + '/' + agentId + '/' + pubTopic
+        elif mode == 'virtual':
+            # Virtual uses a send/recv prefix, and Sub is set in addPeer
+            broadcastPubTopic = commTopic + '/send/' + pubTopic
+        else:
+            # Multimaster and sim use same topic for publishing and subscribing
+            broadcastPubTopic = commTopic + '/' + pubTopic
+            self.broadcastSubTopic = commTopic + '/' + pubTopic
+
+        # Publisher for the packaged data
+        self.data_pub = rospy.Publisher(broadcastPubTopic, AgentMsg, queue_size=1)
+
+    def addPeer(self, nid):
+        Transport.addPeer(self, nid)
+        if self.mode == 'virtual':
+            subTopic = self.commTopic + '/recv/' + nid + '/' + self.pubTopic
+            pubDMReqTopic = self.commTopic + '/send/' + nid + '/dm_request'
+            subDMReqTopic = self.commTopic + '/recv/' + nid + '/dm_request'
+            pubDMRespTopic = self.commTopic + '/send/' + nid + '/dm_response'
+            subDMRespTopic = self.commTopic + '/recv/' + nid + '/dm_response'
+        else:
+            subTopic = '/' + nid + '/' + self.broadcastSubTopic
+            pubDMReqTopic = '/' + self.id + '/' + self.commTopic + '/' + nid + '/dm_request'
+            subDMReqTopic = '/' + nid + '/' + self.commTopic + '/' + self.id + '/dm_request'
+            pubDMRespTopic = '/' + self.id + '/' + self.commTopic + '/' + nid + '/dm_response'
+            subDMRespTopic = '/' + nid + '/' + self.commTopic + '/' + self.id + '/dm_response'
+
+        # Subscribers for the packaged data
+        self.data_sub[nid] = rospy.Subscriber(subTopic, AgentMsg, self.dataHandler)
+
+        # Pairs for direct message requests
+        self.dmReq_pub[nid] = rospy.Publisher(pubDMReqTopic, DMReqArray, queue_size=1)
+        self.dmReq_sub[nid] = rospy.Subscriber(subDMReqTopic, DMReqArray, self.requestHandler, nid)
+
+        # Pairs for direct message responses
+        self.dmResp_pub[nid] = rospy.Publisher(pubDMRespTopic, DMRespArray, queue_size=1)
+        self.dmResp_sub[nid] = rospy.Subscriber(subDMRespTopic, DMRespArray, self.responseHandler, nid)
+
+    def broadcast(self, msg):
+        self.data_pub.publish(msg)
+
+    def sendRequest(self, nid, msg):
+        self.dmReq_pub[nid].publish(msg)
+
+    def sendResponse(self, nid, msg):
+        self.dmResp_pub[nid].publish(msg)
+
+
+class UdpProtocol(object):
+    """ asyncio datagram protocol, handing each datagram to the transport """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def connection_made(self, endpoint):
+        # Large messages arrive as a burst of fragments, so make room for them
+        endpoint.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.transport.endpoint = endpoint
+
+    def datagram_received(self, data, addr):
+        self.transport.received(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class UdpTransport(Transport):
+    """
+    Serialized messages sent straight to each peer's UDP port, skipping ROS topics and relays.
+    Messages larger than a datagram are split into fragments.  A message with a lost fragment is dropped,
+    same as a lost message on any other link.  Needs Python 3 for asyncio.
+    """
+
+    def __init__(self, agentId, dataHandler, requestHandler, responseHandler, port, addresses):
+        if asyncio is None:
+            raise RuntimeError('The UDP transport needs asyncio (Python 3)')
+
+        Transport.__init__(self, agentId, dataHandler, requestHandler, responseHandler)
+        # Peer id to (host, port)
+        self.addresses = addresses
+        self.numbers = itertools.count(1)
+        # (sender, message number) to (first seen, fragments)
+        self.partial = {}
+        self.endpoint = None
+        self.error = None
+
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(port, ready))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        if self.error:
+            raise RuntimeError('Could not open UDP port {}: {}'.format(port, self.error))
+
+    def run(self, port, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: UdpProtocol(self), local_addr=('0.0.0.0', port)))
+        except OSError as e:
+            self.error = e
+            ready.set()
+            return
+
+        ready.set()
+        self.loop.run_forever()
+
+    def addPeer(self, nid):
+        # Peers without an address can't be reached directly
+        if nid in self.addresses:
+            Transport.addPeer(self, nid)
+
+    def frames(self, kind, msg):
+        payload = self.serialize(msg)
+        sender = self.id.encode('utf-8')
+
+        number = next(self.numbers) & 0xffffffff
+        count = max((len(payload) + MAX_FRAGMENT - 1) // MAX_FRAGMENT, 1)
+        return [FRAME.pack(kind, len(sender), number, index, count) + sender +
+                payload[index * MAX_FRAGMENT:(index + 1) * MAX_FRAGMENT] for index in range(count)]
+
+    def send(self, nids, kind, msg):
+        addresses = [self.addresses[nid] for nid in nids if nid in self.addresses]
+        if not addresses:
+            return
+
+        # Serialize here, and only hand the datagrams to the event loop
+        frames = self.frames(kind, msg)
+        self.loop.call_soon_threadsafe(self.sendFrames, addresses, frames)
+
+    def sendFrames(self, addresses, frames):
+        for address in addresses:
+            for frame in frames:
+                self.endpoint.sendto(frame, address)
+
+    def broadcast(self, msg):
+        self.send(self.peers, b'A', msg)
+
+    def sendRequest(self, nid, msg):
+        self.send([nid], b'Q', msg)
+
+    def sendResponse(self, nid, msg):
+        self.send([nid], b'R', msg)
+
+    def received(self, data, addr):
+        if len(data) < FRAME.size:
+            return
+
+        kind, senderLen, number, index, count = FRAME.unpack(data[:FRAME.size])
+        sender = data[FRAME.size:FRAME.size + senderLen].decode('utf-8')
+        fragment = data[FRAME.size + senderLen:]
+        if kind not in KINDS or index >= count:
+            return
+
+        if count == 1:
+            payload = fragment
+        else:
+            # Forget messages that never got all of their fragments
+            now = time.time()
+            for key in [key for key, entry in self.partial.items() if now - entry[0] > 5]:
+                del self.partial[key]
+
+            entry = self.partial.setdefault((sender, number), (now, {}))
+            entry[1][index] = fragment
+            if len(entry[1]) < count:
+                return
+            del self.partial[(sender, number)]
+            payload = b''.join(entry[1][i] for i in range(count))
+
+        self.dispatch(kind, payload, sender)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class ShmRing(object):
+    """
+    Ring buffer in shared memory with one writing process and one reading process.
+    Each side only moves its own counter, so no lock is needed between them.
+    The reader removes the ring when it closes, and flags that first so the writer knows to reopen it.
+    """
+
+    def __init__(self, name, size, create=True):
+        self.name = name
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER.size + size)
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        # Both agents use the ring, so don't let whichever exits first remove it from under the other
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.buf = self.shm.buf
+        self.capacity = self.shm.size - RING_HEADER.size
+
+    def copyIn(self, position, data):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buf[RING_HEADER.size + start:RING_HEADER.size + start + first] = data[:first]
+        if first < len(data):
+            self.buf[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+    def copyOut(self, position, length):
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        data = bytes(self.buf[RING_HEADER.size + start:RING_HEADER.size + start + first])
+        if first < length:
+            data += bytes(self.buf[RING_HEADER.size:RING_HEADER.size + length - first])
+        return data
+
+    def free(self):
+        written, read, closed = RING_HEADER.unpack_from(self.buf, 0)
+        return self.capacity - (written - read)
+
+    def readPosition(self):
+        return RING_HEADER.unpack_from(self.buf, 0)[1]
+
+    def closed(self):
+        return RING_HEADER.unpack_from(self.buf, 0)[2] != 0
+
+    def write(self, kind, payload, flags=FIRST_FRAGMENT | LAST_FRAGMENT):
+        # Returns False if the reader has fallen too far behind to fit this record
+        written = RING_HEADER.unpack_from(self.buf, 0)[0]
+        length = RECORD.size + len(payload)
+        if length > self.free():
+            return False
+
+        self.copyIn(written, RECORD.pack(len(payload), kind, flags))
+        self.copyIn(written + RECORD.size, memoryview(payload))
+        # Only publish the record once it's all in place
+        struct.pack_into('<Q', self.buf, 0, written + length)
+        return True
+
+    def read(self):
+        written, read, closed = RING_HEADER.unpack_from(self.buf, 0)
+        if written == read:
+            return None
+
+        length, kind, flags = RECORD.unpack(self.copyOut(read, RECORD.size))
+        payload = self.copyOut(read + RECORD.size, length)
+        struct.pack_into('<Q', self.buf, 8, read + RECORD.size + length)
+        return kind, flags, payload
+
+    def skip(self):
+        # Drop anything left from a previous run, and let the writer know we're reading again
+        written = RING_HEADER.unpack_from(self.buf, 0)[0]
+        struct.pack_into('<QQ', self.buf, 8, written, 0)
+
+    def close(self, unlink):
+        if unlink:
+            # The writer may still have the ring open, so tell it to look for a new one
+            struct.pack_into('<Q', self.buf, 16, 1)
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            # unlink expects the segment to be tracked, so hand it back just before removing it
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+
+
+class ShmTransport(Transport):
+    """
+    Shared memory rings between agents running on the same host, one for each direction of each pair.
+    Messages are serialized, then copied into the ring and copied back out by the peer, with no sockets
+    or ROS master involved.  Messages larger than a ring are fed through it in fragments as the peer reads.
+    A thread polls our incoming rings.  Needs Python 3.8.
+    """
+
+    def __init__(self, agentId, dataHandler, requestHandler, responseHandler, ringSize, prefix='ma_'):
+        if shared_memory is None:
+            raise RuntimeError('The shared memory transport needs multiprocessing.shared_memory (Python 3.8)')
+
+        Transport.__init__(self, agentId, dataHandler, requestHandler, responseHandler)
+        self.ringSize = ringSize
+        self.prefix = prefix
+        self.outbound = {}
+        self.inbound = {}
+        # Fragments received so far of each peer's current message
+        self.fragments = {}
+        # Peer id to where its reader was stuck when it last stalled us
+        self.stalled = {}
+        self.dropped = 0
+        # Senders can wait on a peer to read, so they don't share a lock with our own reading
+        self.sendLock = threading.Lock()
+        self.readLock = threading.Lock()
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def addPeer(self, nid):
+        Transport.addPeer(self, nid)
+        outbound = ShmRing(self.prefix + self.id + '_' + nid, self.ringSize)
+        inbound = ShmRing(self.prefix + nid + '_' + self.id, self.ringSize)
+        inbound.skip()
+        with self.sendLock:
+            self.outbound[nid] = outbound
+        with self.readLock:
+            self.inbound[nid] = inbound
+
+    def outboundRing(self, nid):
+        # If the peer restarted, its old ring is gone and it reads from a new one under the same name
+        ring = self.outbound.get(nid)
+        if ring and ring.closed():
+            try:
+                reopened = ShmRing(ring.name, self.ringSize, create=False)
+            except FileNotFoundError:
+                # The peer hasn't come back yet
+                return None
+            ring.close(False)
+            self.outbound[nid] = ring = reopened
+            self.stalled.pop(nid, None)
+        return ring
+
+    def writeMessage(self, nid, ring, kind, payload):
+        step = ring.capacity // 4 - RECORD.size
+        fragments = [payload[i:i + step] for i in range(0, max(len(payload), 1), step)]
+        needed = len(fragments) * RECORD.size + len(payload)
+        if needed > ring.free() and needed <= ring.capacity:
+            # It would fit once the peer catches up, but don't hold up the sender, same as a lost message
+            return False
+
+        # A peer that stalled us before and still hasn't read anything isn't worth waiting on again
+        if self.stalled.get(nid) == ring.readPosition():
+            wait = False
+        else:
+            self.stalled.pop(nid, None)
+            wait = True
+
+        for index, fragment in enumerate(fragments):
+            flags = ((FIRST_FRAGMENT if index == 0 else 0) |
+                     (LAST_FRAGMENT if index == len(fragments) - 1 else 0))
+            # Larger than the ring, so wait for the peer to read the earlier fragments, as long as it keeps reading
+            position = ring.readPosition()
+            deadline = time.time() + RING_STALL
+            while not ring.write(kind, fragment, flags):
+                if ring.readPosition() != position:
+                    position = ring.readPosition()
+                    deadline = time.time() + RING_STALL
+                elif not wait or time.time() > deadline:
+                    # The peer will drop the fragments it has when the next message starts
+                    self.stalled[nid] = position
+                    return False
+                time.sleep(0.0005)
+        return True
+
+    def send(self, nids, kind, msg):
+        payload = self.serialize(msg)
+        with self.sendLock:
+            for nid in nids:
+                ring = self.outboundRing(nid)
+                if nid in self.outbound and not (ring and self.writeMessage(nid, ring, kind, payload)):
+                    self.dropped += 1
+                    rospy.logwarn_throttle(10, '{} dropped a {} byte message to {} on shared memory, {} so far'
+                                           .format(self.id, len(payload), nid, self.dropped))
+
+    def broadcast(self, msg):
+        self.send(list(self.peers), b'A', msg)
+
+    def sendRequest(self, nid, msg):
+        self.send([nid], b'Q', msg)
+
+    def sendResponse(self, nid, msg):
+        self.send([nid], b'R', msg)
+
+    def received(self, nid, kind, flags, fragment):
+        if flags & FIRST_FRAGMENT:
+            self.fragments[nid] = []
+        elif nid not in self.fragments:
+            # The start of this message was dropped
+            return
+        self.fragments[nid].append(fragment)
+
+        if flags & LAST_FRAGMENT:
+            self.dispatch(kind, b''.join(self.fragments.pop(nid)), nid)
+
+    def run(self):
+        # Poll quickly while messages are arriving, and back off when idle
+        idle = 0.0001
+        while self.running:
+            with self.readLock:
+                inbound = list(self.inbound.items())
+
+            received = False
+            for nid, ring in inbound:
+                record = ring.read()
+                while record:
+                    received = True
+                    # One bad message or handler error mustn't stop us hearing from every peer
+                    try:
+                        self.received(nid, *record)
+                    except Exception as e:
+                        self.fragments.pop(nid, None)
+                        rospy.logerr('{} error handling shared memory message from {}: {}'.format(self.id, nid, e))
+                    record = ring.read()
+
+            idle = 0.0001 if received else min(idle * 2, 0.005)
+            time.sleep(idle)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        with self.sendLock:
+            for ring in self.outbound.values():
+                ring.close(False)
+            self.outbound = {}
+        with self.readLock:
+            # Each agent removes the rings it reads from
+            for ring in self.inbound.values():
+                ring.close(True)
+            self.inbound = {}
+
+
+if __name__ == '__main__':
+    # Run as: python3 ma_transport.py ros|udp|shm [round trips] [response bytes]
+    # Times a DM request from A answered by B with a response of the given size, on localhost.
+    # The ROS backend needs a roscore.
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'udp'
+    trips = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    answered = threading.Event()
+    transports = {}
+
+    def respond(req, nid):
+        resp = DMResp()
+        resp.id = nid
+        image = ArtifactImg()
+        image.artifact_img.data = b'\0' * size
+        resp.images = [image]
+        transports['B'].sendResponse(nid, DMRespArray([resp]))
+
+    def received(resp, nid):
+        answered.set()
+
+    def ignore(*args):
+        pass
+
+    if backend == 'ros':
+        rospy.init_node('transport_benchmark', anonymous=True)
+        transports['A'] = RosTransport('A', ignore, ignore, received, 'mesh_comm', 'ma_data', 'multimaster')
+        transports['B'] = RosTransport('B', ignore, respond, ignore, 'mesh_comm', 'ma_data', 'multimaster')
+        time.sleep(2)
+    elif backend == 'shm':
+        transports['A'] = ShmTransport('A', ignore, ignore, received, 4000000, 'ma_benchmark_')
+        transports['B'] = ShmTransport('B', ignore, respond, ignore, 4000000, 'ma_benchmark_')
+    else:
+        addresses = {'A': ('127.0.0.1', 47801), 'B': ('127.0.0.1', 47802)}
+        transports['A'] = UdpTransport('A', ignore, ignore, received, 47801, addresses)
+        transports['B'] = UdpTransport('B', ignore, respond, ignore, 47802, addresses)
+    transports['A'].addPeer('B')
+    transports['B'].addPeer('A')
+
+    req = DMReqArray([DMReq()])
+    latencies = []
+    cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+    for trip in range(trips):
+        answered.clear()
+        start = time.time()
+        transports['A'].sendRequest('B', req)
+        if answered.wait(1.0):
+            latencies.append(time.time() - start)
+    cpu = (time.process_time() if hasattr(time, 'process_time') else time.clock()) - cpu
+
+    latencies.sort()
+    if latencies:
+        print('{}: {}/{} answered, median {:.3f} ms, 95th {:.3f} ms, {:.3f} ms CPU per round trip'.format(
+            backend, len(latencies), trips, 1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.95)], 1000 * cpu / trips))
+    else:
+        print('{}: no responses'.format(backend))
+
+    for transport in transports.values():
+        transport.close()
+    if backend == 'ros':
+        rospy.signal_shutdown('Benchmark complete')
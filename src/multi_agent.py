@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 from __future__ import print_function
+import os
 import math
 import hashlib
+import json
+import threading
+import itertools
+import random
+from collections import deque
 import rospy
 import copy
+from io import BytesIO
 
 from std_msgs.msg import Bool
 from std_msgs.msg import String
@@ -25,9 +32,29 @@ from marble_multi_agent.msg import DMReq
 from marble_multi_agent.msg import DMReqArray
 from marble_multi_agent.msg import DMResp
 from marble_multi_agent.msg import DMRespArray
+from marble_multi_agent.msg import DiffSummary
+from marble_multi_agent.msg import FecChunk
+from marble_multi_agent.msg import ImageChunk
+from marble_multi_agent.msg import ImageProgress
 from marble_mapping.msg import OctomapArray
 from marble_mapping.msg import OctomapNeighbors
 
+from ma_journal import StateJournal
+from ma_spool import DiffSpool
+from ma_images import ImageStore, ImageTransfer, chunkCrc, imageDigest
+from ma_links import LinkTable
+from ma_holdings import Holdings, bloomFilter, seqRanges
+from ma_fec import FecAssembler, encodeBlocks
+from ma_transport import RosTransport, UdpTransport, ShmTransport
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Versions for diff lists, unique across every agent so a cached view can't match a different list
+DIFF_VERSIONS = itertools.count(1)
+
 
 def getDist(pos1, pos2):
     return math.sqrt((pos1.x - pos2.x)**2 + (pos1.y - pos2.y)**2 + (pos1.z - pos2.z)**2)
@@ -37,20 +64,172 @@ def getDist2D(pos1, pos2):
     return math.sqrt((pos1.x - pos2.x)**2 + (pos1.y - pos2.y)**2)
 
 
+def msgSize(msg):
+    # Serialized size of a ROS message, which is what actually goes over the link
+    buff = BytesIO()
+    msg.serialize(buff)
+    return buff.tell()
+
+
+def interleave(*lists):
+    # Take one item from each list in turn, so no one list holds up the others
+    merged = []
+    for i in range(max([len(items) for items in lists] + [0])):
+        merged += [items[i] for items in lists if i < len(items)]
+    return merged
+
+
+def reachable(links, source, maxHops=0):
+    """
+    Set of ids that can be reached from source through links (id to set of linked ids).
+    maxHops limits the number of links in a path, 0 for no limit.
+    """
+    if np is None:
+        reach = set([source])
+        frontier = set([source])
+        hops = 0
+        while frontier and (not maxHops or hops < maxHops):
+            frontier = set(nid for cid in frontier for nid in links.get(cid, ())) - reach
+            reach |= frontier
+            hops += 1
+        return reach
+
+    # Expand the whole frontier with one boolean matrix step per hop
+    ids = sorted(set(links) | set(nid for linked in links.values() for nid in linked) | set([source]))
+    index = dict((nid, i) for i, nid in enumerate(ids))
+    adjacency = np.zeros((len(ids), len(ids)), dtype=bool)
+    for cid, linked in links.items():
+        adjacency[index[cid], [index[nid] for nid in linked]] = True
+
+    reach = np.zeros(len(ids), dtype=bool)
+    reach[index[source]] = True
+    frontier = reach.copy()
+    hops = 0
+    while frontier.any() and (not maxHops or hops < maxHops):
+        frontier = adjacency[frontier].any(axis=0) & ~reach
+        reach |= frontier
+        hops += 1
+    return set(ids[i] for i in np.flatnonzero(reach))
+
+
+class BandwidthStats(object):
+    """ Counts messages and bytes sent on each outbound path, split by payload section """
+
+    def __init__(self, window):
+        self.window = window
+        self.lastUpdate = rospy.get_rostime()
+        self.msgs = {}
+        self.bytes = {}
+        self.rates = {}
+        # DM responses are counted from callback threads while the main loop converts to rates
+        self.lock = threading.Lock()
+
+    def record(self, path, msg, sections=None):
+        # Size everything before taking the lock, since that serializes the messages
+        total = msgSize(msg)
+        sizes = {}
+        if sections:
+            for section, parts in sections.items():
+                sizes[section] = sum(msgSize(part) for part in parts)
+            # Anything not attributed to a section is headers and small fields
+            sizes['other'] = total - sum(sizes.values())
+        sizes['total'] = total
+
+        with self.lock:
+            self.msgs[path] = self.msgs.get(path, 0) + 1
+            counts = self.bytes.setdefault(path, {})
+            for section, size in sizes.items():
+                counts[section] = counts.get(section, 0) + size
+
+    def update(self):
+        # Convert the counts to rates once per window, and start counting again
+        now = rospy.get_rostime()
+        elapsed = (now - self.lastUpdate).to_sec()
+        if elapsed < self.window:
+            return False
+
+        with self.lock:
+            msgs, allBytes = self.msgs, self.bytes
+            self.msgs = {}
+            self.bytes = {}
+            self.lastUpdate = now
+
+        self.rates = {}
+        for path, counts in allBytes.items():
+            self.rates[path] = {'msgs': msgs[path] / elapsed,
+                                'bytes': dict((section, size / elapsed)
+                                              for section, size in counts.items())}
+        return True
+
+
+class LazyMsg(object):
+    """ Message attribute that isn't built until it's first used """
+
+    def __init__(self, slot, msgClass, frame_id=None):
+        self.slot = slot
+        self.msgClass = msgClass
+        self.frame_id = frame_id
+
+    def __get__(self, obj, objType=None):
+        if obj is None:
+            return self
+
+        msg = getattr(obj, self.slot)
+        if msg is None:
+            msg = self.msgClass()
+            if self.frame_id:
+                msg.header.frame_id = self.frame_id
+            setattr(obj, self.slot, msg)
+
+        return msg
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
 class Agent(object):
     """ Data structure to hold pertinent information about other agents """
 
-    def __init__(self, agent_id, parent_id, agent_type, report_images):
+    # Slots keep the per-agent footprint small when tracking many agents
+    __slots__ = ('id', 'pid', 'cid', 'type', 'reset', 'reportImages', 'digestImages', 'lastMessage',
+                 'lastDirectMessage', 'incomm', 'simcomm', 'hops', 'spool', 'status', 'guiStamp',
+                 'guiTaskName', 'guiTaskValue', 'guiGoalPoint', 'guiAccept', 'guiGoalAccept',
+                 'odometry', '_exploreGoal', '_explorePath', 'goal', '_goals', '_atnode',
+                 'commBeacons', 'newArtifacts', 'checkArtifacts', 'images', 'missingImages',
+                 'imageDigests', 'knownDigests', 'lastArtifact', 'resetStamp', 'resetAgent', '_mapDiffs',
+                 'updateMapDiffs', 'numDiffs', 'missingDiffs', 'diffClear', 'pendingDiffs', 'diffVersion')
+
+    # Only our own agent uses these, so neighbors never build them
+    exploreGoal = LazyMsg('_exploreGoal', PoseStamped, 'world')
+    explorePath = LazyMsg('_explorePath', Path, 'world')
+    goals = LazyMsg('_goals', GoalArray)
+    atnode = LazyMsg('_atnode', Bool)
+
+    # Our own diffs arrive as a whole new array, so any assignment changes the version too
+    @property
+    def mapDiffs(self):
+        return self._mapDiffs
+
+    @mapDiffs.setter
+    def mapDiffs(self, mapDiffs):
+        self._mapDiffs = mapDiffs
+        self.diffVersion = next(DIFF_VERSIONS)
+
+    def __init__(self, agent_id, parent_id, agent_type, report_images, spool=None, digest_images=False):
         self.id = agent_id
         self.pid = parent_id
         self.cid = ''
         self.type = agent_type
         self.reset = AgentReset()
         self.reportImages = report_images
+        # With an image store the artifact lists don't hold image bytes, so images are hashed by digest
+        self.digestImages = digest_images
         self.lastMessage = rospy.get_rostime()
         self.lastDirectMessage = self.lastMessage
         self.incomm = True
         self.simcomm = True
+        self.hops = 0
+        self.spool = spool
         self.initialize()
         self.initializeMaps()
 
@@ -63,18 +242,19 @@ class Agent(object):
         self.guiAccept = False
         self.guiGoalAccept = False
         self.odometry = Odometry()
-        self.exploreGoal = PoseStamped()
-        self.explorePath = Path()
-        self.exploreGoal.header.frame_id = 'world'
-        self.explorePath.header.frame_id = 'world'
+        self.exploreGoal = None
+        self.explorePath = None
         self.goal = Goal()
-        self.goals = GoalArray()
-        self.atnode = Bool()
+        self.goals = None
+        self.atnode = None
         self.commBeacons = BeaconArray()
         self.newArtifacts = ArtifactArray()
         self.checkArtifacts = ArtifactArray()
         self.images = []
         self.missingImages = []
+        self.imageDigests = {}
+        # Content hash of each artifact's image, as advertised by its owner
+        self.knownDigests = {}
         self.lastArtifact = ''
         self.resetStamp = resetTime
         if resetTime:
@@ -89,6 +269,52 @@ class Agent(object):
         self.numDiffs = numDiffs
         self.missingDiffs = []
         self.diffClear = diffClear
+        # Diffs added since neighbor_maps was last published
+        self.pendingDiffs = []
+        if self.spool:
+            self.spool.clear(self.id)
+
+    # If we have a spool the diffs live there, and mapDiffs only keeps the count
+    def addMapDiff(self, octomap):
+        if self.spool:
+            self.spool.add(self.id, octomap)
+        else:
+            self.mapDiffs.octomaps.append(octomap)
+        self.mapDiffs.num_octomaps += 1
+        self.diffVersion = next(DIFF_VERSIONS)
+        self.pendingDiffs.append(octomap)
+
+    def removeMapDiff(self, seq):
+        if self.spool:
+            self.spool.remove(self.id, seq)
+            return
+
+        for idx, mapDiff in enumerate(self.mapDiffs.octomaps):
+            if mapDiff.header.seq == seq:
+                del self.mapDiffs.octomaps[idx]
+                self.diffVersion = next(DIFF_VERSIONS)
+                break
+
+    def getMapDiffs(self):
+        if self.spool:
+            return self.spool.load(self.id)
+        return self.mapDiffs.octomaps
+
+    def getMapDiffSeqs(self):
+        if self.spool:
+            return self.spool.getSeqs(self.id)
+        return [mapDiff.header.seq for mapDiff in self.mapDiffs.octomaps]
+
+    def getMapDiffArray(self):
+        # Full array of diffs, only loaded from the spool when it's actually needed
+        if not self.spool:
+            return self.mapDiffs
+
+        mapDiffs = OctomapArray()
+        mapDiffs.owner = self.id
+        mapDiffs.num_octomaps = self.mapDiffs.num_octomaps
+        mapDiffs.octomaps = self.getMapDiffs()
+        return mapDiffs
 
     def updateCommon(self, neighbor):
         self.status = neighbor.status
@@ -98,11 +324,17 @@ class Agent(object):
 
         # Update missing diffs if the neighbor said there are new ones
         if not self.diffClear and neighbor.numDiffs > self.numDiffs and not self.reset.ignore:
+            # Some of them may have been pushed to us already
+            held = set(self.getMapDiffSeqs())
             for i in range(self.numDiffs, neighbor.numDiffs):
-                if i not in self.missingDiffs:
+                if i not in self.missingDiffs and i not in held:
                     self.missingDiffs.append(i)
             self.numDiffs = neighbor.numDiffs
 
+        for artifact, digest in zip(neighbor.newArtifacts.artifacts, neighbor.imageDigests):
+            if digest:
+                self.knownDigests[artifact.artifact_id] = digest
+
         # Identify new images available for request
         for artifact in neighbor.newArtifacts.artifacts:
             if (artifact.image_data.format != 'empty' and
@@ -132,12 +364,14 @@ class Agent(object):
             self.lastMessage = neighbor.header.stamp
             self.lastDirectMessage = rospy.get_rostime()
             self.incomm = True
+            self.hops = 1
             self.updateCommon(neighbor)
         else:
             self.updateCommon(neighbor)
             self.cid = neighbor.cid
             self.incomm = False
             self.lastMessage = neighbor.lastMessage.data
+            self.hops = neighbor.hops + 1
 
     def guiUpdate(self, neighbor):
         self.guiStamp = neighbor.guiStamp.data
@@ -161,6 +395,16 @@ class Agent(object):
         self.checkArtifacts.num_artifacts += 1
 
     def updateHash(self):
+        if self.digestImages:
+            for artifact in self.checkArtifacts.artifacts:
+                artifact.image_data.data = []
+            artifactString = repr(self.checkArtifacts.artifacts)
+            # If set, include images when checking if Base has received new artifacts
+            if self.reportImages:
+                artifactString += repr(sorted(self.imageDigests.items()))
+            self.lastArtifact = hashlib.md5(artifactString.encode('utf-8')).hexdigest()
+            return
+
         # If set, ignore images when checking if Base has received new artifacts
         if not self.reportImages:
             for artifact in self.checkArtifacts.artifacts:
@@ -205,6 +449,9 @@ class Base(object):
 class BeaconObj(object):
     """ Data structure to hold pertinent information about beacons """
 
+    __slots__ = ('id', 'owner', 'pos', 'lastMessage', 'lastDirectMessage', 'incomm', 'simcomm',
+                 'active')
+
     def __init__(self, agent, owner):
         self.id = agent
         self.owner = owner
@@ -220,13 +467,18 @@ class BeaconObj(object):
         self.lastDirectMessage = rospy.get_rostime()
 
 
-class ArtifactReport:
+class ArtifactReport(object):
     """
     Internal artifact structure to track reporting.
     Holds full artifact message so neighbors can be fused.
     """
 
-    def __init__(self, agent_id, artifact, sendImages):
+    __slots__ = ('id', 'agent_id', 'artifact', 'reported', 'score', 'new', 'firstSeen',
+                 'lastPublished', 'originals', 'store', 'imageKey', '_image')
+
+    def __init__(self, agent_id, artifact, sendImages, store=None):
+        # If there's an image store, the image is kept there instead of in the report
+        self.store = store
         self.id = artifact.artifact_id
         self.agent_id = agent_id
         self.artifact = artifact
@@ -236,6 +488,7 @@ class ArtifactReport:
         self.firstSeen = rospy.get_rostime()
         self.lastPublished = rospy.Time()
         self.originals = {}
+        self.imageKey = None
 
         # Mark empty data so we receiver doesn't try to request it
         if not artifact.image_data.data or not sendImages:
@@ -243,8 +496,65 @@ class ArtifactReport:
         # Save image so we can send it via DM
         self.image = ArtifactImg()
         if sendImages:
-            self.image.artifact_id = artifact.artifact_id
-            self.image.artifact_img = artifact.image_data
+            image = ArtifactImg()
+            image.artifact_id = artifact.artifact_id
+            # Our own copy, so clearing the artifact's image data doesn't clear this
+            image.artifact_img = copy.copy(artifact.image_data)
+            self.image = image
+
+            # The store has it now, so don't hold on to it in the artifact too
+            if self.imageKey:
+                artifact.image_data = copy.copy(artifact.image_data)
+                artifact.image_data.data = []
+
+    @property
+    def image(self):
+        if self.imageKey:
+            image = ArtifactImg()
+            image.artifact_id = self.id
+            image.artifact_img = self.store.get(self.imageKey)
+            return image
+
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        if self.store and image.artifact_img.data:
+            self.imageKey = self.store.put(image.artifact_img)
+            self._image = ArtifactImg()
+            self._image.artifact_id = image.artifact_id
+        else:
+            self.imageKey = None
+            self._image = image
+
+    def __deepcopy__(self, memo):
+        # The image store is shared and holds a lock, so copy the report's own fields but not the store
+        report = ArtifactReport.__new__(ArtifactReport)
+        memo[id(self)] = report
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            setattr(report, slot, value if slot == 'store' else copy.deepcopy(value, memo))
+        return report
+
+    def hasImage(self):
+        return bool(self.imageKey) or bool(self._image.artifact_img.data)
+
+    def imageDigest(self):
+        if self.imageKey:
+            return self.imageKey
+        return imageDigest(self._image.artifact_img)
+
+
+class DMView(object):
+    """
+    Read-only snapshot of the map diffs and images we can serve in DMs.
+    Rebuilt by the main loop each tick so callbacks never read data while it's being changed.
+    """
+
+    def __init__(self, diffs=None, images=None, digests=None):
+        self.diffs = diffs or {}  # Owner id to {seq: diff}
+        self.images = images or {}  # Artifact id to ArtifactReport with an image
+        self.digests = digests or {}  # Image digest to artifact id holding it
 
 
 class DataListener:
@@ -293,6 +603,8 @@ class MultiAgent(object):
         self.useMonitor = rospy.get_param('multi_agent/monitor', False)
         # Whether to use simulated comms or real comms
         self.useSimComms = rospy.get_param('multi_agent/simcomms', False)
+        # Max links to relay through for simulated comms, 0 for no limit and 1 to disable relaying
+        self.simCommHops = rospy.get_param('multi_agent/simCommHops', 0)
         # Whether to run the agent without a base station (comms always true)
         self.solo = rospy.get_param('multi_agent/solo', False)
         # Whether to include images in reports at all (disable for low bandwidth!)
@@ -305,6 +617,56 @@ class MultiAgent(object):
         self.dmWait = rospy.Duration(rospy.get_param('multi_agent/dmWait', 3))
         # Whether to send DMs in one large message or split for comms
         self.dmSplit = rospy.Duration(rospy.get_param('multi_agent/dmSplit', True))
+        # Split DM responses anyway on links losing more than this fraction of messages
+        self.dmSplitLoss = rospy.get_param('multi_agent/dmSplitLoss', 0.3)
+        # Weight of each new sample in the link quality averages used to pick who to request DMs from
+        linkAlpha = rospy.get_param('multi_agent/linkAlpha', 0.2)
+        # Whether to push new diffs and images to peers in comm, instead of waiting for them to ask
+        self.dmPush = rospy.get_param('multi_agent/dmPush', False)
+        # Max bytes to push each update, shared between peers (0 for no limit)
+        self.dmPushBudget = rospy.get_param('multi_agent/dmPushBudget', 200000)
+        # Whether to send each DM diff or image as erasure coded chunks, so losing some doesn't lose it all
+        self.dmFec = rospy.get_param('multi_agent/dmFec', False)
+        # Bytes in each coded chunk, and parity chunks to add as a fraction of the data chunks
+        self.dmFecChunk = rospy.get_param('multi_agent/dmFecChunk', 8000)
+        self.dmFecParity = rospy.get_param('multi_agent/dmFecParity', 0.25)
+        # Bytes in each chunk images are sent in, so a lost message only loses a chunk (0 to send whole)
+        self.imageChunk = rospy.get_param('multi_agent/imageChunk', 20000)
+        # Publish every neighbor diff each time for the merger ('full'), or only changes ('incremental')
+        self.neighborMapsMode = rospy.get_param('multi_agent/neighborMapsMode', 'full')
+        # Max rate (Hz) to publish each type of monitor topic at when it changes (0 for no limit)
+        monitorRate = rospy.get_param('multi_agent/monitorRate', 1.0)
+        self.monitorRates = dict((topic, monitorRate) for topic in
+                                 ['status', 'incomm', 'gui', 'odometry', 'goal', 'path', 'artifacts', 'image'])
+        self.monitorRates.update(rospy.get_param('multi_agent/monitorRates', {}))
+        # Time to republish monitor topics even if they haven't changed
+        self.monitorRefresh = rospy.Duration(rospy.get_param('multi_agent/monitorRefresh', 10))
+        # Whether to count bytes sent on each outbound path, and the window to report rates over
+        self.useBandwidthStats = rospy.get_param('multi_agent/bandwidthStats', False)
+        bandwidthWindow = rospy.get_param('multi_agent/bandwidthWindow', 5)
+        # Whether to only relay neighbor data that changed or that a peer appears to be missing
+        self.relayPrune = rospy.get_param('multi_agent/relayPrune', False)
+        # Time to resend unchanged neighbor data anyway, so new peers catch up
+        self.relayRefresh = rospy.Duration(rospy.get_param('multi_agent/relayRefresh', 10))
+        # Don't relay neighbor data older than this (0 to disable)
+        self.relayMaxAge = rospy.Duration(rospy.get_param('multi_agent/relayMaxAge', 0))
+        # Don't relay neighbor data that's already this many hops away (0 to disable)
+        self.relayMaxHops = rospy.get_param('multi_agent/relayMaxHops', 0)
+        # Max bytes per broadcast; neighbor data that doesn't fit waits for the next (0 to disable)
+        self.relayBudget = rospy.get_param('multi_agent/relayBudget', 0)
+        # File to journal mission state to for recovery after a restart ('' to disable)
+        journalPath = rospy.get_param('multi_agent/journalPath', '')
+        # Directory to store artifact images in ('' to keep them in memory).
+        # Artifact report hashes then cover image digests, so every agent needs the same setting.
+        imageStorePath = rospy.get_param('multi_agent/imageStorePath', '')
+        # Megabytes of artifact images to keep in memory when using the image store
+        imageCacheSize = rospy.get_param('multi_agent/imageCacheSize', 64)
+        # Minimum time between journal compactions
+        self.journalCompact = rospy.Duration(rospy.get_param('multi_agent/journalCompact', 300))
+        # File to spill older neighbor map diffs to ('' to keep everything in memory)
+        diffSpoolPath = rospy.get_param('multi_agent/diffSpoolPath', '')
+        # Megabytes of neighbor map diffs to keep in memory when spooling
+        diffSpoolCap = rospy.get_param('multi_agent/diffSpoolCap', 256)
         # Total number of potential beacons
         totalBeacons = rospy.get_param('multi_agent/totalBeacons', 16)
         # Potential robot neighbors to monitor
@@ -317,6 +679,13 @@ class MultiAgent(object):
         self.commTopic = rospy.get_param('multi_agent/commTopic', 'mesh_comm')
         useMesh = rospy.get_param('multi_agent/useMesh', False)
         self.useVirtual = rospy.get_param('multi_agent/useVirtual', False)
+        # How to send to peers: 'ros' topics, 'udp' straight to the addresses in udpPeers (id: 'host:port'),
+        # or 'shm' through shared memory when every agent runs on this host
+        transport = rospy.get_param('multi_agent/transport', 'ros')
+        udpPort = rospy.get_param('multi_agent/udpPort', 47800)
+        udpPeers = rospy.get_param('multi_agent/udpPeers', {})
+        # Megabytes for each shared memory ring, one for each direction between each pair of agents
+        shmRingSize = rospy.get_param('multi_agent/shmRingSize', 4)
         # Topics for subscribers
         topics = {}
         topics['odometry'] = rospy.get_param('multi_agent/odomTopic', 'odometry')
@@ -332,23 +701,65 @@ class MultiAgent(object):
             self.reportImages = False
 
         self.neighbors = {}
+        self.diffSpool = None
+        if diffSpoolPath:
+            self.diffSpool = DiffSpool(os.path.expanduser(diffSpoolPath), diffSpoolCap * 1000000)
+        self.imageStore = None
+        if imageStorePath:
+            self.imageStore = ImageStore(os.path.expanduser(imageStorePath), imageCacheSize * 1000000,
+                                         ArtifactImg().artifact_img.__class__)
         self.beacons = {}
         self.beaconsArray = []
-        self.data_sub = {}
+        self.beaconKeys = {}
+        self.relayed = {}
+        self.relayWaiting = {}
+        self.peerStamps = {}
         self.comm_sub = {}
-        self.dmReq_pub = {}
-        self.dmReq_sub = {}
-        self.dmResp_pub = {}
-        self.dmResp_sub = {}
         self.simcomms = {}
         self.commcheck = {}
+        # Simulated links for each checker (id to set of ids in comm), and who we can reach through them
+        self.simLinks = {}
+        self.simReach = set()
+        self.simLinksChanged = False
         self.artifacts = {}
         self.monitor = {}
+        # Last value and time published on each monitor topic, and images waiting to publish
+        self.monitorLast = {}
+        self.imageQueue = deque()
+        # Images we're allowed to publish now, topped up at the image rate, and when we last checked
+        self.imageTokens = 1.0
+        self.lastImageTick = rospy.get_rostime()
+        self.lastImageRefresh = rospy.get_rostime()
+        # Image digest to the artifact id we hold those bytes under
+        self.heldDigests = {}
         self.wait = False  # Change to True to wait for Origin Detection
         self.commListen = False
         self.artifactsUpdated = False
         self.lastDMReq = rospy.Time()
         self.dmReqs = []
+        # Link quality to each peer, for choosing who to request missing data from
+        self.links = LinkTable(linkAlpha, self.rate)
+        # Summary of the diffs and images we can serve, and the last one advertised by each peer
+        self.heldSummary = ([], b'')
+        self.peerHoldings = {}
+        # When each diff and image was last pushed to each peer, so we don't repeat before its summary catches up
+        self.pushed = {}
+        # Coded chunks waiting for enough of the rest to arrive.  Resends use the same chunks so they combine.
+        self.fecChunks = FecAssembler(60)
+        # Numbers each coded send, so a receiver can tell a new send from late chunks of one it finished.
+        # Start somewhere random so two peers sending the same key are unlikely to share numbers.
+        self.fecSerials = itertools.count(random.randrange(1 << 31))
+        # Chunks received so far of each missing image
+        self.imageTransfers = {}
+        # Latest message from each sender, waiting to be processed by the main loop
+        self.commQueue = {}
+        self.commLock = threading.Lock()
+        # DM responses and unknown requesters, also waiting for the main loop
+        self.dmRespQueue = []
+        self.newNeighbors = set()
+        # Snapshot of our data for DM requests, and the cache used to rebuild it cheaply
+        self.dmView = DMView()
+        self.dmViewCache = {}
 
         rospy.init_node(self.id + '_multi_agent')
         self.start_time = rospy.get_rostime()
@@ -356,26 +767,36 @@ class MultiAgent(object):
             self.start_time = rospy.get_rostime()
 
         # Initialize object for our own data
-        self.agent = Agent(self.id, self.id, self.type, self.reportImages)
+        self.agent = Agent(self.id, self.id, self.type, self.reportImages, digest_images=bool(self.imageStore))
         DataListener(self.agent, topics)
 
         # Initialize base station
         self.base = Base()
 
-        if useMesh:
-            # UDP Mesh broadcast publishes to one topic but subscribes to different
-            self.broadcastPubTopic = self.commTopic + '/' + self.pubTopic
-            self.broadcastSubTopic = self.commTopic + '/' + self.id + '/' + self.pubTopic
-        elif self.useVirtual:
-            # Virtual uses a send/recv prefix, and Sub is set in setupComms
-            self.broadcastPubTopic = self.commTopic + '/send/' + self.pubTopic
-        else:
-            # Multimaster and sim use same topic for publishing and subscribing
-            self.broadcastPubTopic = self.commTopic + '/' + self.pubTopic
-            self.broadcastSubTopic = self.commTopic + '/' + self.pubTopic
-
+        self.transport = None
+        if transport == 'udp':
+            try:
+                addresses = dict((nid, (address.split(':')[0], int(address.split(':')[1])))
+                                 for nid, address in udpPeers.items())
+                self.transport = UdpTransport(self.id, self.CommReceiver, self.DMRequestReceiever,
+                                              self.DMResponseReceiever, udpPort, addresses)
+            except RuntimeError as e:
+                rospy.logerr(self.id + ' ' + str(e) + ', using ROS topics')
+        elif transport == 'shm':
+            try:
+                self.transport = ShmTransport(self.id, self.CommReceiver, self.DMRequestReceiever,
+                                              self.DMResponseReceiever, shmRingSize * 1000000)
+            except RuntimeError as e:
+                rospy.logerr(self.id + ' ' + str(e) + ', using ROS topics')
+
+        if not self.transport:
+            mode = 'mesh' if useMesh else 'virtual' if self.useVirtual else 'multimaster'
+            self.transport = RosTransport(self.id, self.CommReceiver, self.DMRequestReceiever,
+                                          self.DMResponseReceiever, self.commTopic, self.pubTopic, mode)
+
+        rospy.on_shutdown(self.transport.close)
         if self.type != 'base':
-            self.setupComms('Base')
+            self.transport.addPeer('Base')
 
         if self.useSimComms:
             self.comm_sub[self.id] = \
@@ -396,14 +817,38 @@ class MultiAgent(object):
             else:
                 self.beacons[nid] = BeaconObj(nid, False)
 
-        self.neighbor_maps_pub = rospy.Publisher('neighbor_maps', OctomapNeighbors, latch=True, queue_size=1)
-
-        # Publisher for the packaged data
-        self.data_pub = rospy.Publisher(self.broadcastPubTopic, AgentMsg, queue_size=1)
+        # A latched delta would be wrong for a late subscriber, so only latch the full messages.
+        # Each delta holds diffs later ones don't repeat, so queue them rather than keep only the newest.
+        fullMaps = self.neighborMapsMode == 'full'
+        self.neighborMapsSent = False
+        self.neighbor_maps_pub = rospy.Publisher('neighbor_maps', OctomapNeighbors,
+                                                 latch=fullMaps, queue_size=1 if fullMaps else 10)
+
+        # Journal to recover from, and the message type and handler for each kind of record
+        self.journal = None
+        self.journalReplaying = False
+        self.lastCompact = rospy.get_rostime()
+        self.journalHandlers = {
+            'reset': (AgentReset, self.replayReset),
+            'beacon': (Beacon, self.replayBeacon),
+            'artifact': (ArtifactArray, self.replayArtifact),
+            'reported': (None, self.replayReported),
+            'image': (ArtifactImg, self.replayImage),
+            'diff': (OctomapArray, self.replayDiff)
+        }
+        if journalPath:
+            self.journal = StateJournal(os.path.expanduser(journalPath))
+
+        # Bandwidth accounting, reported as rates in bytes/sec for each path and section
+        self.bandwidth = None
+        if self.useBandwidthStats:
+            self.bandwidth = BandwidthStats(bandwidthWindow)
+            self.bandwidth_pub = rospy.Publisher('bandwidth', String, queue_size=1, latch=True)
 
     def addNeighbor(self, nid, agent_type):
         if agent_type == 'robot':
-            self.neighbors[nid] = Agent(nid, self.id, agent_type, self.reportImages)
+            self.neighbors[nid] = Agent(nid, self.id, agent_type, self.reportImages, self.diffSpool,
+                                        bool(self.imageStore))
         else:
             # Determine if this agent 'owns' the beacon so we don't have conflicting names
             owner = True if nid in self.myBeacons else False
@@ -411,7 +856,7 @@ class MultiAgent(object):
 
         # Beacons don't run a node in virtual, so don't setup comms
         if agent_type != 'beacon' or (agent_type == 'beacon' and not self.useVirtual):
-            self.setupComms(nid)
+            self.transport.addPeer(nid)
 
         if self.useSimComms:
             comm_topic = '/' + nid + '/commcheck'
@@ -441,48 +886,188 @@ class MultiAgent(object):
             self.monitor[nid]['image'] = \
                 rospy.Publisher(topic + 'image', ArtifactImg, queue_size=10, latch=True)
 
-    def setupComms(self, nid):
-        if self.useVirtual:
-            subTopic = self.commTopic + '/recv/' + nid + '/' + self.pubTopic
-            pubDMReqTopic = self.commTopic + '/send/' + nid + '/dm_request'
-            subDMReqTopic = self.commTopic + '/recv/' + nid + '/dm_request'
-            pubDMRespTopic = self.commTopic + '/send/' + nid + '/dm_response'
-            subDMRespTopic = self.commTopic + '/recv/' + nid + '/dm_response'
+    def countSent(self, path, msg):
+        # Record the size of an outbound message, split into the sections we care about
+        if not self.bandwidth:
+            return
+
+        if isinstance(msg, AgentMsg):
+            sections = {'odometry': [msg.odometry],
+                        'goal': [msg.goal],
+                        'artifacts': [msg.newArtifacts],
+                        'neighbors': msg.neighbors}
+        elif isinstance(msg, DMRespArray):
+            # Coded chunks count towards whatever they carry, which their key names
+            chunks = [chunk for agent in msg.agents for chunk in agent.chunks]
+            sections = {'diffs': [agent.mapDiffs for agent in msg.agents] +
+                                 [chunk for chunk in chunks if '/image/' not in chunk.key],
+                        'images': [image for agent in msg.agents for image in agent.images] +
+                                  [chunk for agent in msg.agents for chunk in agent.imageChunks] +
+                                  [chunk for chunk in chunks if '/image/' in chunk.key]}
+        elif isinstance(msg, OctomapNeighbors):
+            sections = {'diffs': msg.neighbors}
         else:
-            subTopic = '/' + nid + '/' + self.broadcastSubTopic
-            pubDMReqTopic = '/' + self.id + '/' + self.commTopic + '/' + nid + '/dm_request'
-            subDMReqTopic = '/' + nid + '/' + self.commTopic + '/' + self.id + '/dm_request'
-            pubDMRespTopic = '/' + self.id + '/' + self.commTopic + '/' + nid + '/dm_response'
-            subDMRespTopic = '/' + nid + '/' + self.commTopic + '/' + self.id + '/dm_response'
+            sections = None
+
+        self.bandwidth.record(path, msg, sections)
+
+    def publishBandwidth(self):
+        if self.bandwidth and self.bandwidth.update():
+            self.bandwidth_pub.publish(json.dumps(self.bandwidth.rates, sort_keys=True))
+
+    def publishMonitor(self, nid, topic, msg):
+        self.monitor[nid][topic].publish(msg)
+        if self.bandwidth:
+            # Plain values (strings, bools) get wrapped by rospy, so do the same to count them
+            if not hasattr(msg, 'serialize'):
+                msg = self.monitor[nid][topic].data_class(msg)
+            self.countSent('monitor/' + nid + '/' + topic, msg)
+
+    def publishDMResp(self, nid, agents):
+        resp = DMRespArray(agents)
+        self.transport.sendResponse(nid, resp)
+        self.countSent('dmResp/' + nid, resp)
+
+    def publishFec(self, nid, nresp, key, path):
+        # Send a single diff or image response as coded chunks, each in its own message
+        buff = BytesIO()
+        nresp.serialize(buff)
+        payload = buff.getvalue()
+
+        # Large payloads are coded in several blocks, since one block can only have so many chunks
+        serial = next(self.fecSerials)
+        for offset, length, k, chunks in encodeBlocks(payload, self.dmFecChunk, self.dmFecParity):
+            for index, data in enumerate(chunks):
+                chunked = DMResp()
+                chunked.id = nresp.id
+                chunked.chunks = [FecChunk(key=nresp.id + '/' + key, serial=serial, size=len(payload),
+                                           offset=offset, length=length, k=k, index=index, data=data)]
+                resp = DMRespArray([chunked])
+                self.transport.sendResponse(nid, resp)
+                self.countSent(path + nid, resp)
+
+    def diffResp(self, owner, diff):
+        nresp = DMResp()
+        nresp.id = owner
+        nresp.mapDiffs.owner = owner
+        nresp.mapDiffs.num_octomaps = 1
+        nresp.mapDiffs.octomaps = [diff]
+        return nresp
+
+    def imageResp(self, owner, image):
+        nresp = DMResp()
+        nresp.id = owner
+        nresp.images = [image]
+        return nresp
+
+    def imageItems(self, owner, image, progress=None):
+        # Responses for an image, as one per chunk if it's large, or only the chunks the requester is missing
+        if not self.imageChunk or len(image.artifact_img.data) <= self.imageChunk:
+            return [('image/' + image.artifact_id, self.imageResp(owner, image))]
+
+        buff = BytesIO()
+        image.artifact_img.serialize(buff)
+        payload = buff.getvalue()
+        digest = imageDigest(image.artifact_img)
+        count = (len(payload) + self.imageChunk - 1) // self.imageChunk
+
+        indices = range(count)
+        if progress and progress.digest == digest and progress.count == count:
+            indices = progress.missing
+
+        items = []
+        for index in indices:
+            data = payload[index * self.imageChunk:(index + 1) * self.imageChunk]
+            nresp = DMResp()
+            nresp.id = owner
+            nresp.imageChunks = [ImageChunk(image.artifact_id, digest, len(payload), count, index,
+                                            chunkCrc(data), data)]
+            items.append(('image/%s/%d' % (image.artifact_id, index), nresp))
+        return items
+
+    def monitorChanged(self, nid, topic, group, value):
+        # Messages are replaced when updated, so compare those by identity and anything else by value
+        last = self.monitorLast.get((nid, topic))
+        now = rospy.get_rostime()
+        if last:
+            lastValue, lastTime = last
+            if hasattr(value, 'serialize'):
+                changed = value is not lastValue
+            else:
+                changed = value != lastValue
 
-        # Subscribers for the packaged data
-        self.data_sub[nid] = rospy.Subscriber(subTopic, AgentMsg, self.CommReceiver)
+            if not changed and now - lastTime < self.monitorRefresh:
+                return False
 
-        # Pairs for direct message requests
-        self.dmReq_pub[nid] = rospy.Publisher(pubDMReqTopic, DMReqArray, queue_size=1)
-        self.dmReq_sub[nid] = rospy.Subscriber(subDMReqTopic, DMReqArray, self.DMRequestReceiever, nid)
+            # Hold the change until we're allowed to publish this topic again
+            rate = self.monitorRates.get(group, 0)
+            if rate and (now - lastTime).to_sec() < 1.0 / rate:
+                return False
+
+        self.monitorLast[(nid, topic)] = (value, now)
+        return True
 
-        # Pairs for direct message responses
-        self.dmResp_pub[nid] = rospy.Publisher(pubDMRespTopic, DMRespArray, queue_size=1)
-        self.dmResp_sub[nid] = rospy.Subscriber(subDMRespTopic, DMRespArray, self.DMResponseReceiever, nid)
+    def publishMonitorChange(self, nid, topic, group, msg, value=None):
+        if self.monitorChanged(nid, topic, group, msg if value is None else value):
+            self.publishMonitor(nid, topic, msg)
+
+    def monitorArtifacts(self, neighbor):
+        # The image store keeps the bytes out of the artifact list, so put them back for the monitor
+        if not self.imageStore or not self.reportImages:
+            return neighbor.checkArtifacts
+
+        artifacts = copy.copy(neighbor.checkArtifacts)
+        artifacts.artifacts = []
+        for artifact in neighbor.checkArtifacts.artifacts:
+            report = self.artifacts.get(artifact.artifact_id)
+            if report and report.hasImage() and not artifact.image_data.data:
+                artifact = copy.copy(artifact)
+                artifact.image_data = report.image.artifact_img
+            artifacts.artifacts.append(artifact)
+        return artifacts
 
     def publishMonitors(self):
         for neighbor in self.neighbors.values():
-            self.monitor[neighbor.id]['status'].publish(neighbor.status)
-            self.monitor[neighbor.id]['incomm'].publish(neighbor.incomm)
-            self.monitor[neighbor.id]['guiTaskNameReceived'].publish(neighbor.guiTaskName)
-            self.monitor[neighbor.id]['guiTaskValueReceived'].publish(neighbor.guiTaskValue)
+            nid = neighbor.id
+            self.publishMonitorChange(nid, 'status', 'status', neighbor.status)
+            self.publishMonitorChange(nid, 'incomm', 'incomm', neighbor.incomm)
+            self.publishMonitorChange(nid, 'guiTaskNameReceived', 'gui', neighbor.guiTaskName)
+            self.publishMonitorChange(nid, 'guiTaskValueReceived', 'gui', neighbor.guiTaskValue)
             # Don't publish if the robot hasn't initialized odometry
             if (neighbor.odometry.pose.pose.position.x != 0 and
                 neighbor.odometry.pose.pose.position.y != 0):
-                self.monitor[neighbor.id]['odometry'].publish(neighbor.odometry)
-                self.monitor[neighbor.id]['goal'].publish(neighbor.goal.pose)
-                self.monitor[neighbor.id]['path'].publish(neighbor.goal.path)
-                self.monitor[neighbor.id]['artifacts'].publish(neighbor.checkArtifacts)
-        for artifact in self.artifacts.values():
-            if artifact.image.artifact_img.data and rospy.get_rostime() - artifact.lastPublished > rospy.Duration(60) and artifact.agent_id != self.id:
-                self.monitor[artifact.agent_id]['image'].publish(artifact.image)
-                artifact.lastPublished = rospy.get_rostime()
+                self.publishMonitorChange(nid, 'odometry', 'odometry', neighbor.odometry)
+                self.publishMonitorChange(nid, 'goal', 'goal', neighbor.goal.pose)
+                self.publishMonitorChange(nid, 'path', 'path', neighbor.goal.path)
+                # The artifact list is changed in place, so use its size and hash to see changes
+                if self.monitorChanged(nid, 'artifacts', 'artifacts',
+                                       (neighbor.checkArtifacts.num_artifacts, neighbor.lastArtifact)):
+                    self.publishMonitor(nid, 'artifacts', self.monitorArtifacts(neighbor))
+
+        # Publish images as they arrive, and queue them all again every refresh for late subscribers
+        now = rospy.get_rostime()
+        if now - self.lastImageRefresh >= self.monitorRefresh:
+            self.lastImageRefresh = now
+            for aid, artifact in self.artifacts.items():
+                if (artifact.agent_id != self.id and artifact.agent_id in self.monitor and artifact.hasImage() and
+                        now - artifact.lastPublished >= self.monitorRefresh and aid not in self.imageQueue):
+                    self.imageQueue.append(aid)
+
+        # Images are large, so spend at most rate per second, even when that's less than one a tick
+        rate = self.monitorRates.get('image', 0)
+        numImages = len(self.imageQueue)
+        if rate:
+            elapsed = (now - self.lastImageTick).to_sec()
+            self.imageTokens = min(self.imageTokens + rate * elapsed, max(rate, 1.0))
+            numImages = min(numImages, int(self.imageTokens))
+            self.imageTokens -= numImages
+        self.lastImageTick = now
+        for _ in range(numImages):
+            aid = self.imageQueue.popleft()
+            if aid in self.artifacts:
+                artifact = self.artifacts[aid]
+                self.publishMonitor(artifact.agent_id, 'image', artifact.image)
+                artifact.lastPublished = now
 
     def getStatus(self):
         return self.agent.status
@@ -517,6 +1102,9 @@ class MultiAgent(object):
         msg.newArtifacts = copy.deepcopy(agent.checkArtifacts)
         for artifact in msg.newArtifacts.artifacts:
             artifact.image_data.data = []
+        # Advertise image hashes so anyone with the same bytes doesn't need them again
+        msg.imageDigests = [agent.knownDigests.get(artifact.artifact_id, '')
+                            for artifact in msg.newArtifacts.artifacts]
 
         # Data that's only sent via direct comms
         if agent.id == self.id:
@@ -526,9 +1114,102 @@ class MultiAgent(object):
             msg.baseArtifacts = self.base.baseArtifacts
             msg.commBeacons.data = self.beaconsArray
             msg.numDiffs = agent.mapDiffs.num_octomaps
+            msg.heldDiffs, msg.heldImages = self.heldSummary
         else:
             msg.status = agent.status
             msg.numDiffs = agent.numDiffs
+            msg.hops = agent.hops
+
+    def peerInComm(self, pid):
+        if pid == 'Base':
+            return self.base.incomm
+        elif pid in self.beacons:
+            return self.beacons[pid].incomm
+        elif pid in self.neighbors:
+            return self.neighbors[pid].incomm and self.neighbors[pid].cid == self.id
+
+        return False
+
+    def relayKey(self, neighbor):
+        # Anything a receiver would act on counts as a change
+        return (neighbor.lastMessage, neighbor.guiStamp, neighbor.reset.stamp, neighbor.status,
+                neighbor.numDiffs, len(neighbor.checkArtifacts.artifacts))
+
+    def peerStaleness(self, neighbor):
+        # How far behind the furthest behind peer in comm is for this neighbor, in seconds
+        stale = 0
+        for pid, stamps in self.peerStamps.items():
+            if pid != neighbor.id and self.peerInComm(pid):
+                behind = (neighbor.lastMessage - stamps.get(neighbor.id, rospy.Time())).to_sec()
+                stale = max(stale, behind)
+
+        return stale
+
+    def relayCheck(self, neighbor):
+        # Decide whether this neighbor's data is worth sending in our neighbors array
+        if not self.relayPrune:
+            return True
+
+        now = rospy.get_rostime()
+        if self.relayMaxAge and now - max(neighbor.lastMessage, neighbor.guiStamp) > self.relayMaxAge:
+            return False
+
+        if self.relayMaxHops and neighbor.hops >= self.relayMaxHops:
+            return False
+
+        last = self.relayed.get(neighbor.id)
+        if not last or last[0] != self.relayKey(neighbor) or now - last[1] > self.relayRefresh:
+            return True
+
+        # Peers we're talking to tell us what they have, so send it again if any are behind
+        return self.peerStaleness(neighbor) > 0
+
+    def relayPriority(self, neighbor):
+        # Resets and new artifacts matter far more than another odometry update
+        key = self.relayKey(neighbor)
+        last = self.relayed.get(neighbor.id)
+        if not last:
+            priority = 50
+        elif key[2] != last[0][2]:
+            priority = 100
+        elif key[1] != last[0][1] or key[5] != last[0][5]:
+            priority = 50
+        elif key[4] != last[0][4]:
+            priority = 20
+        else:
+            priority = 1
+
+        # Favor what peers are furthest behind on, what's waited longest, and closer agents
+        priority += min(self.peerStaleness(neighbor), 30)
+        priority += 5 * self.relayWaiting.get(neighbor.id, 0)
+        priority -= 2 * neighbor.hops
+
+        return priority
+
+    def relaySelect(self, pubData, relays):
+        # Fill the message with the highest priority neighbor data that fits in the budget
+        if self.relayBudget:
+            size = baseSize = msgSize(pubData)
+            relays.sort(key=lambda relay: self.relayPriority(relay[0]), reverse=True)
+        selected = []
+        for neighbor, msg in relays:
+            if self.relayBudget:
+                msgBytes = msgSize(msg)
+                if size + msgBytes > self.relayBudget:
+                    # Spill into a later message
+                    self.relayWaiting[neighbor.id] = self.relayWaiting.get(neighbor.id, 0) + 1
+                    if baseSize + msgBytes > self.relayBudget:
+                        rospy.logwarn_throttle(30, self.id + ' relay for ' + neighbor.id + ' of ' + str(msgBytes) +
+                                               ' bytes never fits relayBudget')
+                    continue
+                size += msgBytes
+
+            selected.append(msg)
+            self.relayWaiting[neighbor.id] = 0
+            if self.relayPrune or self.relayBudget:
+                self.relayed[neighbor.id] = (self.relayKey(neighbor), rospy.get_rostime())
+
+        return selected
 
     def CommCheck(self):
         if rospy.get_rostime() < self.start_time + self.commThreshold:
@@ -547,7 +1228,7 @@ class MultiAgent(object):
         if self.type != 'base' and not self.solo:
             self.base.incomm = self.base.lastDirectMessage > checkTime
 
-    # Next 3 functions are just for simulated comms.  Otherwise simcomm is True.
+    # Next 2 functions are just for simulated comms.  Otherwise simcomm is True.
     def simCommChecker(self, data, nid):
         # If we're checking our direct comm, set simcomm directly
         if nid == self.id:
@@ -557,30 +1238,30 @@ class MultiAgent(object):
             # Otherwise build our multidimensional checking array
             self.commcheck[nid] = data.data
 
-    def recurCommCheck(self, cid):
-        if cid in self.commcheck:
-            for check in self.commcheck[cid]:
-                if check.incomm and check.id != self.id and not self.simcomms[check.id].incomm:
-                    self.simcomms[check.id].incomm = True
-                    self.recurCommCheck(check.id)
+        # Nobody relays back through us, so our own links are only used from the source
+        links = set(check.id for check in data.data if check.incomm and check.id != self.id)
+        if self.simLinks.get(nid) != links:
+            self.simLinks[nid] = links
+            self.simLinksChanged = True
 
     def simCommCheck(self):
-        # Recursively check who can talk to who
-        # TODO removing this enables us to disable comm hopping...might be useful parameter
-        for cid in self.commcheck:
-            if cid in self.simcomms and self.simcomms[cid].incomm:
-                self.recurCommCheck(cid)
-
-        # Set the simcomm based on the newly modified matrix
+        # Work out who can talk to who, only when a link has changed
+        if self.simLinksChanged:
+            self.simLinksChanged = False
+            links = dict(self.simLinks)
+            links.setdefault(self.id, set())
+            self.simReach = reachable(links, self.id, self.simCommHops)
+
+        # Set the simcomm based on who we can reach
         for simcomm in self.simcomms.values():
             if 'B' in simcomm.id and simcomm.id in self.beacons:
-                self.beacons[simcomm.id].simcomm = simcomm.incomm
+                self.beacons[simcomm.id].simcomm = simcomm.id in self.simReach
             elif simcomm.id != 'Base' and simcomm.id in self.neighbors:
-                self.neighbors[simcomm.id].simcomm = simcomm.incomm
+                self.neighbors[simcomm.id].simcomm = simcomm.id in self.simReach
 
         # Base comms are whatever our status with the anchor is
         if self.simcomms and self.id != 'Base':
-            self.base.simcomm = self.simcomms['Base'].incomm
+            self.base.simcomm = 'Base' in self.simReach
 
     def beaconCommCheck(self, data):
         return True
@@ -590,6 +1271,35 @@ class MultiAgent(object):
         if not self.commListen:
             return
 
+        # Only queue the message here so the main loop owns all of the neighbor data.
+        # If a sender bursts, only its newest message is kept.
+        with self.commLock:
+            self.links.messageReceived(data.id, rospy.get_rostime().to_sec(), data.header.stamp.to_sec())
+            queued = self.commQueue.get(data.id)
+            if not queued or data.header.stamp >= queued.header.stamp:
+                self.commQueue[data.id] = data
+
+    def processComms(self):
+        # Swap out the queues so callbacks can keep adding while we process this batch
+        with self.commLock:
+            queue = self.commQueue
+            self.commQueue = {}
+            dmRespQueue = self.dmRespQueue
+            self.dmRespQueue = []
+            newNeighbors = self.newNeighbors
+            self.newNeighbors = set()
+
+        for nid in newNeighbors:
+            if nid not in self.neighbors:
+                self.addNeighbor(nid, 'robot')
+
+        for data in queue.values():
+            self.processCommMessage(data)
+
+        for resp in dmRespQueue:
+            self.processDMResponse(resp)
+
+    def processCommMessage(self, data):
         # If I'm a beacon, don't do anything with the data unless activated!
         if self.type == 'beacon':
             if not self.beaconCommCheck(data):
@@ -620,8 +1330,14 @@ class MultiAgent(object):
                 self.base.updateArtifacts(self.id, data)
 
         if runComm:
+            self.peerHoldings[data.id] = Holdings(data.heldDiffs, data.heldImages)
+
             # Get our neighbor's neighbors' data and update our own neighbor list
+            stamps = self.peerStamps.setdefault(data.id, {})
             for neighbor2 in data.neighbors:
+                # Track what this peer knows so we can tell if it's missing anything
+                stamps[neighbor2.id] = neighbor2.lastMessage.data
+
                 # Make sure the neighbor isn't ourself, it's not a stale message,
                 # and we've already talked directly to the neighbor in the last N seconds
                 if neighbor2.id != self.id:
@@ -662,6 +1378,9 @@ class MultiAgent(object):
         nid = data.agent
         if nid and applyAgent and data.stamp > self.neighbors[nid].resetStamp:
             rospy.loginfo(self.id + ' resetting data for ' + nid)
+            self.journalAppend('reset', nid, data)
+            if self.journal:
+                self.journal.dead += 1
             self.neighbors[nid].resetStamp = data.stamp
             self.neighbors[nid].diffClear = data.clear
 
@@ -683,13 +1402,7 @@ class MultiAgent(object):
                 # If we got a sequence then remove just these from our local map
                 for seq in data.seqs:
                     self.neighbors[nid].diffClear = True
-                    remove = None
-                    for idx, mapDiff in enumerate(self.neighbors[nid].mapDiffs.octomaps):
-                        if mapDiff.header.seq == seq:
-                            remove = idx
-                            break
-                    if remove != None:
-                        del self.neighbors[nid].mapDiffs.octomaps[remove]
+                    self.neighbors[nid].removeMapDiff(seq)
 
             # Save the data.  Have to do it here in case we did ma_reset
             self.neighbors[nid].guiStamp = rospy.get_rostime()
@@ -716,113 +1429,347 @@ class MultiAgent(object):
             for neighbor in self.neighbors.values():
                 neighbor.initializeMaps(0, True)
 
+            # Most of the journal is now out of date, so compact on the next chance
+            if self.journal:
+                self.journal.dead += 1
+                self.lastCompact = rospy.Time()
+
             return True
 
         return False
 
-    def addMapDiffs(self, nid, nresp, agent):
+    def updateDMView(self):
+        # Only rebuild an owner's diff lookup if its list has changed since the last snapshot
+        diffs = {}
+        heldDiffs = []
+        agents = [self.agent] + list(self.neighbors.values())
+        for agent in agents:
+            # Spooled diffs are looked up directly, the spool handles its own locking
+            if agent.spool:
+                diffs[agent.id] = agent.spool.view(agent.id)
+                ranges = seqRanges(agent.getMapDiffSeqs())
+            else:
+                cached = self.dmViewCache.get(agent.id)
+                if not cached or cached[0] != agent.diffVersion:
+                    lookup = dict((diff.header.seq, diff) for diff in agent.mapDiffs.octomaps)
+                    cached = (agent.diffVersion, lookup, seqRanges(lookup.keys()))
+                    self.dmViewCache[agent.id] = cached
+                diffs[agent.id] = cached[1]
+                ranges = cached[2]
+
+            if ranges:
+                heldDiffs.append(DiffSummary(agent.id, ranges))
+
+        # Images are fetched from the reports when requested, so they aren't all loaded here
+        images = {}
+        for artifact in self.artifacts.values():
+            if artifact.hasImage():
+                images[artifact.id] = artifact
+
+        # Swapping the reference is atomic, so callbacks always see a complete view
+        self.dmView = DMView(diffs, images, dict(self.heldDigests))
+
+        # Advertise what we can serve so peers can ask whoever actually has what they're missing
+        imageKeys = list(images) + list(self.heldDigests) if images else []
+        self.heldSummary = (heldDiffs, bloomFilter(imageKeys) if imageKeys else b'')
+
+    def addMapDiffs(self, nresp, agent, view, split):
+        # Returns each requested diff as its own response if splitting, otherwise adds them to nresp
         nresp.mapDiffs.owner = agent.id
         nresp.mapDiffs.num_octomaps = 0
 
-        if agent.id == self.id:
-            mapDiffs = self.agent.mapDiffs.octomaps
-        else:
-            mapDiffs = self.neighbors[agent.id].mapDiffs.octomaps
+        mapDiffs = view.diffs.get(agent.id, {})
 
-        # Add each requested diff to the message
+        items = []
         for i in agent.missingDiffs:
-            for mapDiff in mapDiffs:
-                if mapDiff.header.seq == i:
-                    nresp.mapDiffs.octomaps.append(mapDiff)
-                    nresp.mapDiffs.num_octomaps += 1
-                    if self.dmSplit:
-                        # If splitting responses, publish then reset the response message
-                        self.dmResp_pub[nid].publish([nresp])
-                        nresp = DMResp()
-                        nresp.id = agent.id
-                        nresp.mapDiffs.owner = agent.id
-                        nresp.mapDiffs.num_octomaps = 0
-                    break
-
-    def addImages(self, nid, nresp, agent):
-        # Add each requested image to the message
-        for i in agent.missingImages:
-            for artifact in self.artifacts.values():
-                if artifact.image.artifact_id == i and artifact.image.artifact_img.data:
-                    nresp.images.append(artifact.image)
-                    if self.dmSplit:
-                        # If splitting responses, publish then reset the response message
-                        self.dmResp_pub[nid].publish([nresp])
-                        nresp = DMResp()
-                        nresp.id = agent.id
-                    break
+            if i in mapDiffs and split:
+                items.append(('diff/%d' % i, self.diffResp(agent.id, mapDiffs[i])))
+            elif i in mapDiffs:
+                nresp.mapDiffs.octomaps.append(mapDiffs[i])
+                nresp.mapDiffs.num_octomaps += 1
+        return items
+
+    def addImages(self, nresp, agent, view, split):
+        # Returns each requested image or image chunk as its own response if splitting, otherwise adds them to nresp
+        progress = dict((p.artifact_id, p) for p in agent.imageProgress)
+
+        items = []
+        for idx, i in enumerate(agent.missingImages):
+            artifact = view.images.get(i)
+            # We might have the same image under another artifact id
+            if not artifact and idx < len(agent.imageDigests):
+                artifact = view.images.get(view.digests.get(agent.imageDigests[idx]))
+
+            if artifact:
+                image = artifact.image
+                if image.artifact_id != i:
+                    image = ArtifactImg(artifact_id=i, artifact_img=image.artifact_img)
+                items += self.imageItems(agent.id, image, progress.get(i))
+
+        if not split:
+            for key, item in items:
+                nresp.images += item.images
+                nresp.imageChunks += item.imageChunks
+            return []
+        return items
 
     def DMRequestReceiever(self, req, nid):
         # TODO add a time check so we don't try to send again if we already sent recently,
         # as the comms client may be trying to take care of the resend
+        # Serve from the latest snapshot so we never block or race the main loop
+        view = self.dmView
+        # Lossy links lose less when each diff or image goes in its own message
+        split = self.dmSplit or self.dmFec or self.links.lossRate(nid) > self.dmSplitLoss
         resp = []
+        diffItems = []
+        imageItems = []
         for agent in req.agents:
             nresp = DMResp()
             nresp.id = agent.id
 
             # We might receive a request for an agent we didn't know about before so add neighbor
-            if agent.id != self.id and agent.id not in self.neighbors:
-                self.addNeighbor(agent.id, 'robot')
+            if agent.id != self.id and agent.id not in view.diffs:
+                with self.commLock:
+                    self.newNeighbors.add(agent.id)
 
-            self.addMapDiffs(nid, nresp, agent)
-            self.addImages(nid, nresp, agent)
-            if not self.dmSplit:
+            diffItems += self.addMapDiffs(nresp, agent, view, split)
+            imageItems += self.addImages(nresp, agent, view, split)
+            if not split:
                 resp.append(nresp)
 
-        if not self.dmSplit:
-            self.dmResp_pub[nid].publish(resp)
+        if not split:
+            self.publishDMResp(nid, resp)
+            return
+
+        # Alternate diffs with images so a large image doesn't hold up the map
+        for key, item in interleave(diffItems, imageItems):
+            if self.dmFec:
+                self.publishFec(nid, item, key, 'dmResp/')
+            else:
+                self.publishDMResp(nid, [item])
 
     def DMResponseReceiever(self, resp, nid):
+        # Responses change our neighbor data, so leave them for the main loop
+        with self.commLock:
+            self.links.responseReceived(nid, rospy.get_rostime().to_sec())
+            self.dmRespQueue.append(resp)
+
+    def addMapDiff(self, neighbor, octomap):
+        neighbor.addMapDiff(octomap)
+        neighbor.updateMapDiffs = True
+        # Remove the received diffs, in case we didn't get all of them
+        if octomap.header.seq in neighbor.missingDiffs:
+            neighbor.missingDiffs.remove(octomap.header.seq)
+
+        self.journalAppend('diff', neighbor.id, self.diffArray(neighbor.id, octomap))
+
+    def addImage(self, neighbor, image):
+        if image.artifact_id not in self.artifacts:
+            return False
+
+        artifact = self.artifacts[image.artifact_id]
+        artifact.image = image
+        digest = artifact.imageDigest()
+        self.heldDigests[digest] = image.artifact_id
+        if image.artifact_id not in neighbor.knownDigests:
+            neighbor.knownDigests[image.artifact_id] = digest
+
+        # Add the image to the checkArtifact so we can update the hash table
+        if self.reportImages:
+            for checkArtifact in neighbor.checkArtifacts.artifacts:
+                if checkArtifact.artifact_id == image.artifact_id:
+                    if neighbor.digestImages:
+                        # Only the format is needed, the bytes are compared by digest
+                        checkArtifact.image_data = copy.copy(image.artifact_img)
+                        checkArtifact.image_data.data = []
+                        neighbor.imageDigests[image.artifact_id] = digest
+                    else:
+                        checkArtifact.image_data = image.artifact_img
+                    neighbor.updateHash()
+                    self.artifactsUpdated = True
+                    break
+
+        # Remove the received image, in case we didn't get all of them
+        if image.artifact_id in neighbor.missingImages:
+            neighbor.missingImages.remove(image.artifact_id)
+
+        if self.useMonitor and neighbor.id in self.monitor:
+            self.imageQueue.append(image.artifact_id)
+
+        self.journalAppend('image', neighbor.id, image)
+        return True
+
+    def resolveImages(self, neighbor):
+        # Use images we already hold the same bytes for, instead of requesting them again
+        for aid in list(neighbor.missingImages):
+            held = self.heldDigests.get(neighbor.knownDigests.get(aid))
+            if held in self.artifacts and self.artifacts[held].hasImage():
+                self.addImage(neighbor, ArtifactImg(artifact_id=aid,
+                                                    artifact_img=self.artifacts[held].image.artifact_img))
+
+    def countHeld(self, pid, reqs):
+        # Number of the requested diffs and images this peer has advertised holding
+        holdings = self.peerHoldings.get(pid)
+        if not holdings:
+            return 0
+
+        count = 0
+        for req in reqs.agents:
+            count += len([seq for seq in req.missingDiffs if holdings.hasDiff(req.id, seq)])
+            for aid, digest in zip(req.missingImages, req.imageDigests):
+                if holdings.hasImage(aid) or holdings.hasImage(digest):
+                    count += 1
+        return count
+
+    def processDMResponse(self, resp):
         receivedDM = False
-        for agent in resp.agents:
+        now = rospy.get_rostime().to_sec()
+        agents = list(resp.agents)
+        for agent in agents:
+            # Once enough coded chunks are in, the rebuilt response is handled like any other
+            for chunk in agent.chunks:
+                payload = self.fecChunks.add(chunk.key, chunk.k, chunk.size, chunk.index, chunk.data, now,
+                                             chunk.serial, chunk.offset, chunk.length)
+                if payload is not None:
+                    agents.append(DMResp().deserialize(payload))
+
+            # Pushed data may be for an agent we haven't heard from yet, so leave it to requests
+            if agent.id not in self.neighbors:
+                continue
+
             neighbor = self.neighbors[agent.id]
+            held = set(neighbor.getMapDiffSeqs()) if agent.mapDiffs.octomaps else set()
             # Add the new diffs to our array and update the total
             for octomap in agent.mapDiffs.octomaps:
-                neighbor.mapDiffs.octomaps.append(octomap)
-                neighbor.mapDiffs.num_octomaps += 1
-                neighbor.updateMapDiffs = True
-                # Remove the received diffs, in case we didn't get all of them
-                if octomap.header.seq in neighbor.missingDiffs:
-                    neighbor.missingDiffs.remove(octomap.header.seq)
-                receivedDM = True
-
-            # Add the new images to our artifacts
-            for image in agent.images:
-                for artifact in self.artifacts.values():
-                    if artifact.artifact.artifact_id == image.artifact_id:
-                        artifact.image = image
-                        # Add the image to the checkArtifact so we can update the hash table
-                        if self.reportImages:
-                            for checkArtifact in neighbor.checkArtifacts.artifacts:
-                                if checkArtifact.artifact_id == image.artifact_id:
-                                    checkArtifact.image_data = image.artifact_img
-                                    neighbor.updateHash()
-                                    self.artifactsUpdated = True
-                                    break
-
-                        # Remove the received image, in case we didn't get all of them
-                        if image.artifact_id in neighbor.missingImages:
-                            neighbor.missingImages.remove(image.artifact_id)
-                        receivedDM = True
-                        break
+                seq = octomap.header.seq
+                if seq in neighbor.missingDiffs:
+                    receivedDM = True
+                elif seq in held or not self.acceptPushedDiff(neighbor, seq):
+                    # Pushed diffs weren't asked for, so we may already have them or have removed them
+                    continue
+                self.addMapDiff(neighbor, octomap)
+                held.add(seq)
+
+            # Add the new images to our artifacts, including any just completed from chunks
+            images = list(agent.images)
+            for chunk in agent.imageChunks:
+                image = self.addImageChunk(chunk)
+                if image:
+                    images.append(image)
+
+            for image in images:
+                missing = image.artifact_id in neighbor.missingImages
+                if self.addImage(neighbor, image) and missing:
+                    receivedDM = True
 
         # Clear out the request log so we don't skip any
         if receivedDM:
             self.lastDMReq = rospy.get_rostime() - self.dmWait
             self.dmReqs = []
 
+    def acceptPushedDiff(self, neighbor, seq):
+        # Same diffs we would have requested: none while ignored or clearing, and only ones past what
+        # we've seen, since older ones we don't hold were removed by a reset
+        return (not neighbor.reset.ignore and not neighbor.diffClear and seq >= neighbor.numDiffs and
+                seq not in neighbor.reset.seqs)
+
+    def addImageChunk(self, chunk):
+        # Returns the image once all of its chunks are in
+        transfer = self.imageTransfers.get(chunk.artifact_id)
+        if not transfer or transfer.digest != chunk.digest or transfer.count != chunk.count:
+            transfer = ImageTransfer(chunk.digest, chunk.size, chunk.count)
+            self.imageTransfers[chunk.artifact_id] = transfer
+
+        payload = transfer.add(chunk.index, chunk.crc, chunk.data)
+        if payload is None:
+            return None
+
+        del self.imageTransfers[chunk.artifact_id]
+        image = ArtifactImg()
+        image.artifact_id = chunk.artifact_id
+        image.artifact_img.deserialize(payload)
+        # Every chunk passed its check, but make sure they were all from the same image
+        if imageDigest(image.artifact_img) != chunk.digest:
+            return None
+        return image
+
+    def pushFresh(self):
+        # Send peers in comm the diffs and images they haven't advertised yet, instead of waiting for a request
+        view = self.dmView
+        now = rospy.get_rostime()
+        peers = [pid for pid in self.peerHoldings if self.transport.hasPeer(pid) and self.peerInComm(pid)]
+        if not peers:
+            return
+
+        budget = self.dmPushBudget / len(peers)
+        digests = dict((aid, digest) for digest, aid in view.digests.items())
+        for pid in peers:
+            holdings = self.peerHoldings[pid]
+            pushed = self.pushed.setdefault(pid, {})
+            # Forget pushes old enough that the peer's summary would show them by now
+            for key in [key for key, stamp in pushed.items() if now - stamp > self.dmWait]:
+                del pushed[key]
+
+            sent = 0
+            resp = []
+            # Only diffs newer than any the peer holds.  Gaps are left for it to request.
+            for owner, diffs in view.diffs.items():
+                if owner == pid:
+                    continue
+
+                last = holdings.lastSeq(owner)
+                for seq in sorted(seq for seq in diffs.keys() if seq > last and (owner, seq) not in pushed):
+                    diff = diffs[seq]
+                    size = msgSize(diff)
+                    if budget and sent + size > budget:
+                        break
+
+                    resp.append(('diff/%d' % seq, self.diffResp(owner, diff)))
+                    pushed[(owner, seq)] = now
+                    sent += size
+
+            for aid, artifact in view.images.items():
+                if (artifact.agent_id == pid or ('image', aid) in pushed or holdings.hasImage(aid) or
+                        holdings.hasImage(digests.get(aid))):
+                    continue
+
+                image = artifact.image
+                size = msgSize(image)
+                if budget and sent + size > budget:
+                    break
+
+                resp += self.imageItems(artifact.agent_id, image)
+                pushed[('image', aid)] = now
+                sent += size
+
+            if not resp:
+                continue
+
+            if self.dmFec:
+                for key, nresp in resp:
+                    self.publishFec(pid, nresp, key, 'dmPush/')
+                continue
+
+            # Same as responses, either one message per diff or image, or all together
+            resp = [nresp for key, nresp in resp]
+            for agents in ([[nresp] for nresp in resp] if self.dmSplit else [resp]):
+                msg = DMRespArray(agents)
+                self.transport.sendResponse(pid, msg)
+                self.countSent('dmPush/' + pid, msg)
+
     def requestMissing(self):
         # If we've made a request recently, give it some time to try someone else
         if rospy.get_rostime() - self.lastDMReq < self.dmWait:
             return
 
+        # Anyone we asked that still hasn't answered counts against their link
+        with self.commLock:
+            for pid in self.dmReqs:
+                self.links.requestExpired(pid)
+
         # Build a full request list of all missing diffs
-        requestFrom = False
+        candidates = []
+        missingImages = set()
         reqs = DMReqArray()
         for neighbor in self.neighbors.values():
             # This neighbors' request
@@ -836,71 +1783,99 @@ class MultiAgent(object):
                 addRequest = True
 
             # Look for missing images and add to request
+            self.resolveImages(neighbor)
             if neighbor.missingImages:
                 req.missingImages = neighbor.missingImages
+                req.imageDigests = [neighbor.knownDigests.get(aid, '') for aid in neighbor.missingImages]
+                # Only ask for the chunks we don't have yet, from whoever we ask next
+                for aid in neighbor.missingImages:
+                    if aid in self.imageTransfers:
+                        transfer = self.imageTransfers[aid]
+                        req.imageProgress.append(ImageProgress(aid, transfer.digest, transfer.count,
+                                                               transfer.missing()))
                 addRequest = True
+            missingImages.update(neighbor.missingImages)
 
             if addRequest:
                 reqs.agents.append(req)
-                # Request directly from the first one we have missing maps from
-                if not requestFrom and neighbor.incomm:
-                    requestFrom = neighbor.id
+                # Prefer requesting directly from the ones we have missing maps from
+                if neighbor.incomm:
+                    candidates.append(neighbor.id)
+
+        # Drop partly received images that nobody is missing any more
+        for aid in [aid for aid in self.imageTransfers if aid not in missingImages]:
+            del self.imageTransfers[aid]
 
         # If we have any, find someone to request from
         if reqs.agents:
-            # Try the base station first; stationary presumed more reliable!
-            if not requestFrom and self.id != 'Base' and self.base.incomm and 'Base' not in self.dmReqs:
-                requestFrom = 'Base'
-
-            # Try beacons next
-            if not requestFrom:
-                for beacon in self.beacons.values():
-                    if self.id != beacon.id and beacon.incomm and beacon.id not in self.dmReqs:
-                        requestFrom = beacon.id
-                        break
-
-            # Finally try robots
-            if not requestFrom:
-                for neighbor in self.neighbors.values():
-                    if neighbor.incomm and neighbor.id not in self.dmReqs:
-                        requestFrom = neighbor.id
-                        break
+            # Then the base station; stationary presumed more reliable!
+            if self.id != 'Base' and self.base.incomm:
+                candidates.append('Base')
+
+            # Then beacons, and finally robots
+            candidates += [beacon.id for beacon in self.beacons.values()
+                           if self.id != beacon.id and beacon.incomm]
+            candidates += [neighbor.id for neighbor in self.neighbors.values() if neighbor.incomm]
+
+            # Pick the fastest expected link, keeping the order above for links we know nothing about
+            requestFrom = False
+            candidates = [pid for pid in candidates if pid not in self.dmReqs]
+            if candidates:
+                default = self.dmWait.to_sec()
+                held = dict((pid, self.countHeld(pid, reqs)) for pid in candidates)
+                if any(held.values()):
+                    # Only ask peers that hold some of it, by the expected time per item they'd send
+                    requestFrom = min([pid for pid in candidates if held[pid]],
+                                      key=lambda pid: self.links.expectedDelivery(pid, default) / held[pid])
+                else:
+                    # Nobody is known to hold it, so try them in turn
+                    requestFrom = min(candidates, key=lambda pid: self.links.expectedDelivery(pid, default))
 
             # Publish the request to this agent
             if requestFrom:
                 self.lastDMReq = rospy.get_rostime()
                 self.dmReqs.append(requestFrom)
-                self.dmReq_pub[requestFrom].publish(reqs)
+                with self.commLock:
+                    self.links.requestSent(requestFrom, self.lastDMReq.to_sec())
+                self.transport.sendRequest(requestFrom, reqs)
+                self.countSent('dmReq/' + requestFrom, reqs)
             else:
                 # If we're missing a map but don't have anyone to request from, start over
                 self.lastDMReq = rospy.get_rostime() - self.dmWait
                 self.dmReqs = []
 
+    def activateBeacon(self, bid, pos):
+        # Beacons only ever become active, so add it to the published array once here
+        beacon = self.beacons[bid]
+        beacon.pos = pos
+        beacon.active = True
+
+        commBeacon = Beacon()
+        commBeacon.id = beacon.id
+        commBeacon.active = beacon.active
+        commBeacon.pos = beacon.pos
+        self.beaconsArray.append(commBeacon)
+        self.journalAppend('beacon', bid, commBeacon)
+
+    def checkBeacons(self, cid, commBeacons):
+        # Beacons only change by activating, so if the same beacons are active as last time
+        # there's nothing new to look at.  A restarted neighbor may send a different list of the same size.
+        key = tuple((beacon.id, beacon.active) for beacon in commBeacons.data)
+        if self.beaconKeys.get(cid) == key:
+            return
+        self.beaconKeys[cid] = key
+
+        for beacon in commBeacons.data:
+            if beacon.active and not self.beacons[beacon.id].active:
+                self.activateBeacon(beacon.id, beacon.pos)
+
     def updateBeacons(self):
+        # Make sure our beacon list matches our neighbors'
         for neighbor in self.neighbors.values():
-            # Make sure our beacon list matches our neighbors'
-            for beacon in neighbor.commBeacons.data:
-                if beacon.active and not self.beacons[beacon.id].active:
-                    self.beacons[beacon.id].pos = beacon.pos
-                    self.beacons[beacon.id].active = True
+            self.checkBeacons(neighbor.id, neighbor.commBeacons)
 
         if self.type != 'base':
-            for beacon in self.base.commBeacons.data:
-                if beacon.active and not self.beacons[beacon.id].active:
-                    self.beacons[beacon.id].pos = beacon.pos
-                    self.beacons[beacon.id].active = True
-
-        # Update the beacons array that gets published with all known active beacons
-        commBeacons = []
-        for beacon in self.beacons.values():
-            if beacon.active:
-                commBeacon = Beacon()
-                commBeacon.id = beacon.id
-                commBeacon.active = beacon.active
-                commBeacon.pos = beacon.pos
-                commBeacons.append(commBeacon)
-
-        self.beaconsArray = commBeacons
+            self.checkBeacons('Base', self.base.commBeacons)
 
     def artifactCheck(self, agent):
         updateString = False
@@ -939,10 +1914,17 @@ class MultiAgent(object):
                         updateString = True
 
                 # Now add the artifact to the array
-                self.artifacts[aid] = ArtifactReport(agent.id, artifact, self.sendImages)
+                self.journalAppend('artifact', agent.id, self.artifactArray(agent.id, artifact))
+                self.artifacts[aid] = ArtifactReport(agent.id, artifact, self.sendImages, self.imageStore)
 
                 if addArtifact:
                     agent.addArtifact(artifact)
+                    # Track our own image so the hash matches once the base has received it
+                    if agent.id == self.id and self.artifacts[aid].hasImage():
+                        digest = self.artifacts[aid].imageDigest()
+                        agent.imageDigests[aid] = digest
+                        agent.knownDigests[aid] = digest
+                        self.heldDigests[digest] = aid
                 else:
                     self.artifacts[aid].reported = True
 
@@ -966,10 +1948,174 @@ class MultiAgent(object):
             if updatedArtifacts:
                 self.artifactsUpdated = True
 
+    def buildNeighborMaps(self, clear):
+        # Full mode, or anything was removed: clear, then send every diff for the merger
+        neighbor_diffs = OctomapNeighbors()
+        incremental = self.neighborMapsMode == 'incremental' and not clear and self.neighborMapsSent
+        neighbor_diffs.clear = clear
+        for neighbor in self.neighbors.values():
+            if not incremental:
+                neighbor_diffs.neighbors.append(neighbor.getMapDiffArray())
+                neighbor_diffs.num_neighbors += 1
+            elif neighbor.pendingDiffs:
+                # Incremental: only the diffs added since the last publish, to add to the map
+                mapDiffs = OctomapArray()
+                mapDiffs.owner = neighbor.id
+                mapDiffs.num_octomaps = len(neighbor.pendingDiffs)
+                mapDiffs.octomaps = neighbor.pendingDiffs
+                neighbor_diffs.neighbors.append(mapDiffs)
+                neighbor_diffs.num_neighbors += 1
+
+            neighbor.pendingDiffs = []
+
+        self.neighborMapsSent = True
+        return neighbor_diffs
+
+    def journalAppend(self, kind, key, msg=None):
+        if self.journal and not self.journalReplaying:
+            self.journal.append(kind, key, msg)
+
+    def artifactArray(self, owner, artifact):
+        artifacts = ArtifactArray()
+        artifacts.owner = owner
+        artifacts.num_artifacts = 1
+        artifacts.artifacts = [artifact]
+        return artifacts
+
+    def diffArray(self, owner, octomap):
+        mapDiffs = OctomapArray()
+        mapDiffs.owner = owner
+        mapDiffs.num_octomaps = 1
+        mapDiffs.octomaps = [octomap]
+        return mapDiffs
+
+    def journalState(self):
+        # Everything needed to rebuild our current state, in the order it should be replayed
+        records = []
+        if self.agent.resetStamp:
+            records.append(('reset', self.id, self.agent.reset))
+        for neighbor in self.neighbors.values():
+            if neighbor.resetStamp:
+                records.append(('reset', neighbor.id, neighbor.reset))
+
+        for beacon in self.beaconsArray:
+            records.append(('beacon', beacon.id, beacon))
+
+        artifacts = sorted(self.artifacts.values(), key=lambda artifact: artifact.firstSeen)
+        for artifact in artifacts:
+            records.append(('artifact', artifact.agent_id,
+                            self.artifactArray(artifact.agent_id, artifact.artifact)))
+        for artifact in artifacts:
+            if artifact.reported:
+                records.append(('reported', artifact.id, None))
+            if artifact.agent_id != self.id and artifact.hasImage():
+                records.append(('image', artifact.agent_id, artifact.image))
+
+        for neighbor in self.neighbors.values():
+            for octomap in neighbor.getMapDiffs():
+                records.append(('diff', neighbor.id, self.diffArray(neighbor.id, octomap)))
+
+        return records
+
+    def journalMaintain(self):
+        if not self.journal:
+            return
+
+        self.journal.flush()
+        if self.journal.dead and rospy.get_rostime() - self.lastCompact > self.journalCompact:
+            # The file is written and synced in the background, so comms carry on meanwhile
+            if self.journal.compact(self.journalState):
+                self.lastCompact = rospy.get_rostime()
+
+    def replayJournal(self):
+        if not self.journal:
+            return
+
+        self.journalReplaying = True
+        numRecords = 0
+        for kind, key, payload in self.journal.records():
+            if kind not in self.journalHandlers:
+                continue
+
+            msgClass, handler = self.journalHandlers[kind]
+            try:
+                msg = msgClass().deserialize(payload) if msgClass else None
+                handler(key, msg)
+            except Exception as e:
+                rospy.logerr('Error replaying journal %s record: %s', kind, str(e))
+                break
+            numRecords += 1
+
+        self.replayFinish()
+        self.journalReplaying = False
+        if numRecords:
+            rospy.loginfo(self.id + ' recovered ' + str(numRecords) + ' records from journal')
+
+    def replayReset(self, key, data):
+        if key == self.id:
+            self.agent.reset = data
+            self.agent.resetStamp = data.stamp
+        elif key in self.neighbors:
+            self.resetDataCheck(data)
+
+    def replayBeacon(self, key, beacon):
+        if key in self.beacons and not self.beacons[key].active:
+            self.activateBeacon(key, beacon.pos)
+
+    def replayArtifact(self, key, artifacts):
+        if key == self.id:
+            agent = self.agent
+        else:
+            if key not in self.neighbors:
+                self.addNeighbor(key, 'robot')
+            agent = self.neighbors[key]
+
+        # Run it through the normal checks, without losing what the subscriber already gave us
+        newArtifacts = agent.newArtifacts
+        agent.newArtifacts = artifacts
+        if self.artifactCheck(agent):
+            self.artifactsUpdated = True
+        agent.newArtifacts = newArtifacts
+
+    def replayReported(self, key, msg):
+        if key in self.artifacts:
+            self.artifacts[key].reported = True
+
+    def replayImage(self, key, image):
+        if key in self.neighbors:
+            neighbor = self.neighbors[key]
+            # Mark it as known so it isn't requested again
+            if image.artifact_id not in neighbor.images:
+                neighbor.images.append(image.artifact_id)
+            self.addImage(neighbor, image)
+
+    def replayDiff(self, key, mapDiffs):
+        if key not in self.neighbors:
+            self.addNeighbor(key, 'robot')
+        for octomap in mapDiffs.octomaps:
+            self.addMapDiff(self.neighbors[key], octomap)
+
+    def replayFinish(self):
+        # Pick up the diff sequence where we left off, so we only request the gaps
+        for neighbor in self.neighbors.values():
+            seqs = set(neighbor.getMapDiffSeqs())
+            if seqs and max(seqs) + 1 > neighbor.numDiffs:
+                neighbor.numDiffs = max(seqs) + 1
+                if not neighbor.diffClear:
+                    neighbor.missingDiffs = [i for i in range(neighbor.numDiffs) if i not in seqs]
+
+        # Our own beacons that are already active have been deployed
+        if self.myBeacons[0] != '':
+            self.numBeacons = len([beacon for beacon in self.beacons.values()
+                                   if beacon.owner and not beacon.active])
+
     def run(self):
         return False
 
     def start(self):
+        # Recover anything we had before a restart
+        self.replayJournal()
+
         # Wait to start running anything until we've gotten some data and can confirm comms
         # This should also help to recover any beacons being published by other nodes
         # Need to wait for origin detection before we do anything else
@@ -983,6 +2129,9 @@ class MultiAgent(object):
             if self.useSimComms:
                 self.simCommCheck()
 
+            # Process the latest messages and DM responses received from each neighbor
+            self.processComms()
+
             # Update incomm based on last message seen
             self.CommCheck()
 
@@ -992,9 +2141,14 @@ class MultiAgent(object):
             # Request any missing data from each agent
             self.requestMissing()
 
+            # Report rates every tick, since DM traffic goes on even when run() skips the rest
+            self.publishBandwidth()
+
             # Execute the type-specific functions
             if not self.run():
                 # If run returns False (usually for an inactive beacon), skip rest of the function
+                self.updateDMView()
+                self.journalMaintain()
                 rate.sleep()
                 continue
 
@@ -1004,18 +2158,16 @@ class MultiAgent(object):
             # Build the data message for self and neighbors
             pubData = AgentMsg()
             self.buildAgentMessage(pubData, self.agent)
-            neighbor_diffs = OctomapNeighbors()
             pubMapDiffs = False
+            clearMapDiffs = False
+            relays = []
             for neighbor in self.neighbors.values():
                 # Check this neighbor to see if anything should be reset
                 self.resetDataCheck(neighbor.reset)
-                msg = NeighborMsg()
-                self.buildAgentMessage(msg, neighbor)
-                pubData.neighbors.append(msg)
-
-                # Get all of the map diffs to publish for the merger
-                neighbor_diffs.neighbors.append(neighbor.mapDiffs)
-                neighbor_diffs.num_neighbors += 1
+                if self.relayCheck(neighbor):
+                    msg = NeighborMsg()
+                    self.buildAgentMessage(msg, neighbor)
+                    relays.append((neighbor, msg))
 
                 # Only publish if we have new diffs or we've removed some
                 if neighbor.updateMapDiffs or neighbor.diffClear:
@@ -1023,20 +2175,30 @@ class MultiAgent(object):
                     pubMapDiffs = True
 
                     if neighbor.diffClear:
-                        neighbor_diffs.clear = True
+                        clearMapDiffs = True
                         neighbor.diffClear = False
 
             pubData.header.stamp = rospy.get_rostime()
-            self.data_pub.publish(pubData)
+            pubData.neighbors = self.relaySelect(pubData, relays)
+            self.transport.broadcast(pubData)
+            self.countSent('data', pubData)
             if pubMapDiffs or hardReset:
+                neighbor_diffs = self.buildNeighborMaps(clearMapDiffs or hardReset)
                 if hardReset:
                     # Only pass hardReset for resetting self map!
                     neighbor_diffs.hardReset = True
-                    neighbor_diffs.clear = True
                 self.neighbor_maps_pub.publish(neighbor_diffs)
+                self.countSent('neighbor_maps', neighbor_diffs)
 
             if self.useMonitor:
                 self.publishMonitors()
 
+            # Give DM requests a consistent view of everything we changed this tick
+            self.updateDMView()
+            if self.dmPush:
+                self.pushFresh()
+
+            self.journalMaintain()
+
             rate.sleep()
         return